@@ -0,0 +1,81 @@
+import os
+
+from integrity import IntegrityIndex, algorithm_id, new_hasher
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Local content-addressed cache shared by every project under one install directory. It holds no
+# data of its own: the index records which installed file has each checksum, and a file another
+# project already has is copied from there instead of downloaded. Projects never share an inode,
+# so a file edited in place in one project changes no other. A source is trusted while its
+# (size, mtime_ns, inode) is unchanged, and every copy is hashed as it is written.
+class BlobCache:
+    def __init__(self, directory):
+        self.root = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(directory, exist_ok=True)
+        # Keyed by the installed file's path relative to the install directory
+        self.index = IntegrityIndex(os.path.join(directory, "index.json"))
+        self.sources = {}
+        for name, entry in self.index.entries.items():
+            self.sources.setdefault(entry.get("checksum"), set()).add(name)
+
+    def lookup(self, checksum, algorithm="sha256"):
+        for name in list(self.sources.get(checksum, ())):
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                stat = None
+            if stat is not None and self.index.lookup(name, stat, algorithm) == checksum:
+                return name
+            self.forget(name)
+        return None
+
+    def install(self, checksum, target_path, file_info=None):
+        # Copies a cached file into place; False when there is none or it no longer has the content
+        name = self.lookup(checksum, algorithm_id(file_info))
+        if name is None:
+            return False
+        temp_path = f"{target_path}.blob"
+        hasher = new_hasher(file_info)
+        try:
+            with open(os.path.join(self.root, name), "rb") as source, open(temp_path, "wb") as target:
+                for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    target.write(chunk)
+            if hasher.hexdigest() != checksum:
+                # Edited while keeping its size and mtime, or while it was being copied
+                self.forget(name)
+                os.remove(temp_path)
+                return False
+            os.replace(temp_path, target_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    def add(self, checksum, file_path, stat, algorithm="sha256"):
+        # stat is the verified file's
+        name = os.path.relpath(os.path.abspath(file_path), self.root)
+        self.index.record(name, stat, checksum, algorithm)
+        self.sources.setdefault(checksum, set()).add(name)
+
+    def forget(self, name):
+        entry = self.index.entries.get(name)
+        if entry is not None:
+            self.sources.get(entry.get("checksum"), set()).discard(name)
+        self.index.forget(name)
+
+    def prune(self):
+        # Drops files that were removed or changed since they were added
+        for name, entry in list(self.index.entries.items()):
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                stat = None
+            if stat is None or self.index.lookup(name, stat, entry.get("algorithm", "sha256")) is None:
+                self.forget(name)
+
+    def save(self):
+        self.prune()
+        self.index.save()
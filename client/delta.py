@@ -0,0 +1,60 @@
+import os
+import zlib
+import hashlib
+
+from integrity import new_hasher
+
+# Block-level patching against the signatures published in block_signatures.json.
+# The local copy is hashed in the server's block size; a block is reused when its
+# adler32 matches one of the new file's weak hashes and its sha256 confirms it, wherever
+# it sits in the new file. Everything else is fetched from /blocks/.
+
+def plan_blocks(local_file_path, signature):
+    block_size = signature["block_size"]
+    weak_hashes = set(signature["weak"])
+    wanted = set(signature["strong"])
+    available = {}
+    with open(local_file_path, "rb") as f:
+        offset = 0
+        for chunk in iter(lambda: f.read(block_size), b""):
+            # The cheap weak hash filters out almost every changed block before sha256 runs
+            if zlib.adler32(chunk) in weak_hashes:
+                strong = hashlib.sha256(chunk).hexdigest()
+                if strong in wanted and strong not in available:
+                    available[strong] = (offset, len(chunk))
+            offset += len(chunk)
+    return [available.get(strong) for strong in signature["strong"]]
+
+def missing_blocks(plan):
+    return [index for index, source in enumerate(plan) if source is None]
+
+def read_exactly(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise IOError(f"Block stream ended after {len(data)} of {size} bytes")
+        data += chunk
+    return bytes(data)
+
+def build_file(local_file_path, target_path, signature, plan, block_stream):
+    # block_stream yields the missing blocks back to back, in index order
+    block_size = signature["block_size"]
+    # The signature carries the manifest's hash algorithm, tree hashes included
+    checksum = new_hasher(signature)
+    with open(local_file_path, "rb") as local, open(target_path, "wb") as target:
+        for index, source in enumerate(plan):
+            if source is not None:
+                offset, length = source
+                local.seek(offset)
+                chunk = local.read(length)
+            else:
+                length = block_size
+                if index == len(plan) - 1:
+                    length = signature["size"] - index * block_size
+                chunk = read_exactly(block_stream, length)
+            checksum.update(chunk)
+            target.write(chunk)
+    if checksum.hexdigest() != signature["checksum"]:
+        os.remove(target_path)
+        raise IOError("Patched file does not match the server checksum")
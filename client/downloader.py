@@ -0,0 +1,411 @@
+import io
+import os
+import time
+import zlib
+import random
+import tarfile
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import delta
+from integrity import new_hasher
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS") or 0) or 4
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES") or 0) or 3
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF") or 0) or 1.0
+# A server at capacity answers 503 with Retry-After; those waits do not use up DOWNLOAD_RETRIES
+BUSY_RETRIES = int(os.getenv("BUSY_RETRIES") or 0) or 30
+# Files up to BUNDLE_MAX_FILE_SIZE are fetched together through /bundle/,
+# in batches of at most BUNDLE_MAX_FILES files / BUNDLE_MAX_BYTES bytes
+BUNDLE_MAX_FILE_SIZE = int(os.getenv("BUNDLE_MAX_FILE_SIZE") or 0) or 1024 * 1024
+BUNDLE_MAX_FILES = int(os.getenv("BUNDLE_MAX_FILES") or 0) or 512
+BUNDLE_MAX_BYTES = int(os.getenv("BUNDLE_MAX_BYTES") or 0) or 64 * 1024 * 1024
+# Whole-file downloads accept the server's pre-compressed variants up to ENCODED_MAX_SIZE; encoded
+# downloads cannot be resumed, larger files are asked for as they are so a dropped connection resumes
+ACCEPT_ENCODING = "zstd, gzip" if zstandard is not None else "gzip"
+ENCODED_MAX_SIZE = int(os.getenv("ENCODED_MAX_SIZE") or 0) or 64 * 1024 * 1024
+
+def decompressor(encoding):
+    if encoding == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise IOError(f"Unsupported content encoding {encoding}")
+
+# Seconds a 503 asks to wait before retrying, None for any other error
+def busy_delay(error):
+    if not isinstance(error, requests.HTTPError) or error.response is None or error.response.status_code != 503:
+        return None
+    retry_after = error.response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return RETRY_BACKOFF
+
+class ChecksumMismatch(IOError):
+    pass
+
+def install_file(temp_path, target_path):
+    # A verified temp file is flushed to disk before it atomically replaces the target,
+    # so a crash leaves either the previous file or the complete new one
+    with open(temp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, target_path)
+
+# Byte counters shared by all download workers
+class DownloadProgress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.total = 0
+        self.done = 0
+        self.transferred = 0
+
+    def add_total(self, size):
+        with self.lock:
+            self.total += size
+
+    # transferred differs from size for compressed transfers, which count their encoded bytes
+    def add(self, size, transferred=None):
+        with self.lock:
+            self.done += size
+            self.transferred += size if transferred is None else transferred
+
+    # Bytes that count towards the total without crossing the network (resumed or patched files)
+    def skip(self, size):
+        with self.lock:
+            self.done += size
+
+    def snapshot(self):
+        with self.lock:
+            elapsed_time = time.time() - self.start_time
+            speed = self.transferred / elapsed_time if elapsed_time > 0 else 0
+            return self.done, self.total, speed
+
+# Downloads a project's pending files on a bounded worker pool sharing one pooled session.
+# Work is ordered largest first so big files start early, failed jobs are retried with
+# exponential backoff, and partial downloads resume from where the previous attempt stopped.
+# With blob_store, whole files come from the cacheable GET /blobs/<checksum> instead of POST /files/.
+class Downloader:
+    def __init__(self, server_url, project, log, on_complete, progress=None,
+                 workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, backoff=RETRY_BACKOFF, blob_store=False):
+        self.server_url = server_url
+        self.project = project
+        self.blob_store = blob_store
+        self.log = log
+        self.on_complete = on_complete
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.progress = progress or DownloadProgress()
+        self.received = set()
+        self.received_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def download_files(self, pending, project_dir):
+        for _, file_info in pending:
+            self.progress.add_total(file_info.get("size", 0))
+
+        # Small files go out in bundles, anything a bundle did not deliver is retried on its own
+        batches, single = self.plan_bundles(pending)
+        jobs = [
+            (sum(file_info["size"] for _, file_info in batch), "bundle", self.download_bundle, (batch, project_dir))
+            for batch in batches
+        ]
+        jobs += [
+            (file_info.get("size", 0), file_name, self.download_one, (file_name, file_info, project_dir))
+            for file_name, file_info in single
+        ]
+        self.run(jobs)
+
+        leftovers = [item for batch in batches for item in batch if item[0] not in self.received]
+        self.run([
+            (file_info.get("size", 0), file_name, self.download_one, (file_name, file_info, project_dir))
+            for file_name, file_info in leftovers
+        ])
+
+    def run(self, jobs):
+        jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.with_retries, fn, *args): label for _, label, fn, args in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.log(f"Error downloading {futures[future]}: {str(e)}")
+
+    def with_retries(self, fn, *args):
+        attempt = 0
+        busy = 0
+        while True:
+            try:
+                return fn(*args)
+            except Exception as e:
+                delay = busy_delay(e)
+                if delay is not None and busy < BUSY_RETRIES:
+                    busy += 1
+                    # Spread the retries out, clients turned away together should not return together
+                    delay *= 1 + random.random()
+                    self.log(f"Server busy, retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                attempt += 1
+                self.log(f"{str(e)}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def plan_bundles(self, pending):
+        # Only files whose size the manifest reports can be bundled
+        batches = []
+        batch = []
+        batch_bytes = 0
+        single = []
+        for file_name, file_info in pending:
+            file_size = file_info.get("size")
+            if file_size is None or file_size > BUNDLE_MAX_FILE_SIZE:
+                single.append((file_name, file_info))
+                continue
+            if batch and (len(batch) >= BUNDLE_MAX_FILES or batch_bytes + file_size > BUNDLE_MAX_BYTES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append((file_name, file_info))
+            batch_bytes += file_size
+        if len(batch) > 1:
+            batches.append(batch)
+        else:
+            single.extend(batch)
+        return batches, single
+
+    def download_one(self, file_name, file_info, project_dir):
+        local_file_path = os.path.join(project_dir, file_name)
+        server_checksum = file_info.get("checksum")
+        file_size = file_info.get("size", 0)
+        # Large files with block signatures are patched from the local copy when possible
+        patched = (
+            file_info.get("block_size")
+            and os.path.exists(local_file_path)
+            and self.patch_file(file_name, local_file_path, server_checksum)
+        )
+        if patched:
+            self.progress.skip(file_size)
+        elif not self.download_blob(local_file_path, file_info):
+            self.download_file_with_speed(
+                f"{self.server_url}/files/",
+                {"project": self.project, "filename": file_name},
+                local_file_path,
+                file_info,
+            )
+        self.on_complete(file_name, server_checksum)
+        self.log(f"{'Patched' if patched else 'Downloaded'} {file_name}")
+
+    def download_blob(self, local_file_path, file_info):
+        # False when the server has no blob store, not this blob or a blob with other content
+        # (a cache along the way may hold a stale one), /files/ serves it then
+        if not self.blob_store or not file_info.get("checksum"):
+            return False
+        try:
+            self.download_file_with_speed(f"{self.server_url}/blobs/{file_info['checksum']}", None, local_file_path, file_info)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            self.discard_partial_file(local_file_path)
+            return False
+        except ChecksumMismatch:
+            self.log(f"Blob {file_info['checksum']} does not match its checksum, downloading the file instead")
+            self.discard_partial_file(local_file_path)
+            return False
+        return True
+
+    def download_bundle(self, batch, project_dir):
+        # A retried bundle only asks for the files earlier attempts did not deliver
+        with self.received_lock:
+            wanted = {file_name: file_info for file_name, file_info in batch if file_name not in self.received}
+        if not wanted:
+            return
+        checksums = {file_name: file_info.get("checksum") for file_name, file_info in wanted.items()}
+        response = self.session.post(
+            f"{self.server_url}/bundle/",
+            json={"project": self.project, "filenames": list(checksums)},
+            headers={"Accept-Encoding": ACCEPT_ENCODING},
+            stream=True,
+        )
+        response.raise_for_status()
+        response.raw.decode_content = True
+        # Unpack members as they arrive, the archive is never held in memory or on disk
+        with tarfile.open(fileobj=response.raw, mode="r|") as tar:
+            for member in tar:
+                if member.name not in checksums or member.name in self.received or not member.isfile():
+                    continue
+                local_file_path = os.path.join(project_dir, member.name)
+                partial_path = f"{local_file_path}.part"
+                with tar.extractfile(member) as source:
+                    chunks = iter(lambda: source.read(16384), b"")
+                    self.write_verified(chunks, partial_path, wanted[member.name], member.pax_headers.get("encoding"))
+                install_file(partial_path, local_file_path)
+                with self.received_lock:
+                    self.received.add(member.name)
+                self.on_complete(member.name, checksums[member.name])
+                self.log(f"Downloaded {member.name}")
+        with self.received_lock:
+            missing = len(checksums) - len(self.received.intersection(checksums))
+        if missing:
+            raise IOError(f"Bundle ended with {missing} files missing")
+
+    def patch_file(self, file_name, local_file_path, server_checksum):
+        data = {"project": self.project, "filename": file_name}
+        patched_path = f"{local_file_path}.delta"
+        try:
+            response = self.session.post(f"{self.server_url}/block_signatures/", json=data)
+            response.raise_for_status()
+            signature = response.json()
+            if signature["checksum"] != server_checksum:
+                return False
+
+            plan = delta.plan_blocks(local_file_path, signature)
+            missing = delta.missing_blocks(plan)
+            if missing:
+                response = self.session.post(
+                    f"{self.server_url}/blocks/", json={**data, "blocks": missing}, stream=True
+                )
+                response.raise_for_status()
+                block_stream = response.raw
+            else:
+                block_stream = io.BytesIO()
+            delta.build_file(local_file_path, patched_path, signature, plan, block_stream)
+            install_file(patched_path, local_file_path)
+            self.log(f"{file_name}: reused {len(plan) - len(missing)} of {len(plan)} blocks")
+            return True
+        except Exception as e:
+            if os.path.exists(patched_path):
+                os.remove(patched_path)
+            # A busy server is asked again through with_retries, the full file would only add load
+            if busy_delay(e) is not None:
+                raise
+            self.log(f"Patching {file_name} failed, downloading it in full: {str(e)}")
+            return False
+
+    def download_file_with_speed(self, url, data, local_file_path, file_info):
+        # POSTs data as JSON, or GETs the url when data is None.
+        # Keep interrupted downloads next to the target and resume them with a Range request
+        partial_path = f"{local_file_path}.part"
+        etag_path = f"{partial_path}.etag"
+        headers = {"Accept-Encoding": ACCEPT_ENCODING if file_info.get("size", 0) <= ENCODED_MAX_SIZE else "identity"}
+        resume_from = 0
+        if os.path.exists(partial_path) and os.path.exists(etag_path):
+            with open(etag_path, "r") as f:
+                etag = f.read().strip()
+            resume_from = os.path.getsize(partial_path)
+            if resume_from and etag:
+                headers["Range"] = f"bytes={resume_from}-"
+                headers["If-Range"] = etag
+                headers["Accept-Encoding"] = "identity"
+
+        response = self.session.request("GET" if data is None else "POST", url, json=data, headers=headers, stream=True)
+        if response.status_code == 416:
+            # The partial file no longer matches the server copy, start over
+            response.close()
+            self.discard_partial_file(local_file_path)
+            return self.download_file_with_speed(url, data, local_file_path, file_info)
+        response.raise_for_status()
+        if response.headers.get("Content-Encoding"):
+            return self.download_encoded(response, local_file_path, file_info)
+
+        # Bytes are hashed as they stream in, the file is never read back to verify it
+        checksum = new_hasher(file_info)
+        if response.status_code == 206:
+            mode = "ab"
+            # A resumed download hashes the part already on disk first
+            with open(partial_path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    checksum.update(chunk)
+            self.progress.skip(resume_from)
+        else:
+            mode = "wb"
+            resume_from = 0
+        content_length = response.headers.get("content-length")
+        total_length = resume_from + int(content_length or 0)
+        with open(etag_path, "w") as f:
+            f.write(response.headers.get("ETag", ""))
+
+        downloaded = resume_from
+        try:
+            with open(partial_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=16384):
+                    if chunk:
+                        f.write(chunk)
+                        checksum.update(chunk)
+                        downloaded += len(chunk)
+                        self.progress.add(len(chunk))
+            if content_length is not None and downloaded != total_length:
+                raise IOError(f"Incomplete download: {downloaded} of {total_length} bytes")
+            if checksum.hexdigest() != file_info.get("checksum"):
+                self.discard_partial_file(local_file_path)
+                raise ChecksumMismatch("Downloaded file does not match the server checksum")
+        except Exception:
+            # The retry resumes the partial file (or starts over) and counts its bytes again
+            self.progress.skip(-downloaded)
+            raise
+
+        os.remove(etag_path)
+        install_file(partial_path, local_file_path)
+
+    def download_encoded(self, response, local_file_path, file_info):
+        # Pre-compressed variants cannot be resumed, so no .part.etag is kept for them
+        self.discard_partial_file(local_file_path)
+        partial_path = f"{local_file_path}.part"
+        chunks = response.raw.stream(16384, decode_content=False)
+        self.write_verified(chunks, partial_path, file_info, response.headers["Content-Encoding"])
+        install_file(partial_path, local_file_path)
+
+    def write_verified(self, chunks, partial_path, file_info, encoding=None):
+        # Decompress (for pre-compressed variants) and hash while writing, then check the result
+        # against the manifest checksum; progress counts decoded bytes as done, received as transferred
+        decoder = decompressor(encoding) if encoding else None
+        checksum = new_hasher(file_info)
+        written = 0
+        try:
+            with open(partial_path, "wb") as f:
+                for chunk in chunks:
+                    data = decoder.decompress(chunk) if decoder else chunk
+                    f.write(data)
+                    checksum.update(data)
+                    written += len(data)
+                    self.progress.add(len(data), transferred=len(chunk))
+                if decoder:
+                    data = decoder.flush()
+                    f.write(data)
+                    checksum.update(data)
+                    written += len(data)
+                    self.progress.add(len(data), transferred=0)
+            if checksum.hexdigest() != file_info.get("checksum"):
+                os.remove(partial_path)
+                raise ChecksumMismatch("Downloaded file does not match the server checksum")
+        except Exception:
+            self.progress.skip(-written)
+            raise
+
+    def discard_partial_file(self, local_file_path):
+        for path in (f"{local_file_path}.part", f"{local_file_path}.part.etag"):
+            if os.path.exists(path):
+                os.remove(path)
@@ -4,11 +4,15 @@ import hashlib
 import logging
 import threading
 import time
+import queue
 import requests
 import customtkinter
 import datetime
 from tkinter import filedialog
 
+from downloader import DownloadProgress
+from sync import fetch_project_name, sync_project
+
 customtkinter.set_appearance_mode("System")  # Modes: system (default), light, dark
 customtkinter.set_default_color_theme("blue")  # Themes: blue (default), dark-blue, green
 
@@ -21,6 +25,7 @@ logger = logging.getLogger(__name__)
 
 SERVER_URL = os.getenv("API_URL")
 LOCAL_DIR = "./game/"
+PROGRESS_INTERVAL = 250  # in milliseconds
 
 class App:
     def __init__(self, root):
@@ -53,6 +58,11 @@ class App:
         )
         self.update_button.pack(pady=10)
 
+        self.verify_button = customtkinter.CTkButton(
+            root, text="Verify All Files", command=self.verify_game, font=("Ubuntu", 12, "bold")
+        )
+        self.verify_button.pack(pady=5)
+
         self.info_frame = customtkinter.CTkFrame(root)
         self.info_frame.pack(pady=10, fill=customtkinter.BOTH, expand=True)
 
@@ -83,7 +93,14 @@ class App:
 
         self.server_status = False
         self.check_server_status()
-        self.completed_files = {}  # Dictionary to store completed files information
+
+        # Worker threads never touch widgets: they publish log lines and byte counters here
+        # and the Tk main loop samples both every PROGRESS_INTERVAL
+        self.messages = queue.Queue()
+        self.progress = DownloadProgress()
+        self.update_thread = None
+        self.last_sample = None
+        self.smoothed_speed = 0
 
     def select_directory(self):
         self.local_dir = filedialog.askdirectory()
@@ -93,7 +110,11 @@ class App:
         else:
             self.text_area.insert(customtkinter.END, "No directory selected.\n")
 
-    def update_game(self):
+    def verify_game(self):
+        self.update_game(verify_all=True)
+
+    # verify_all rehashes every file instead of trusting the integrity index
+    def update_game(self, verify_all=False):
         self.project = self.entry_project.get().strip()
         if not self.project:
             self.text_area.insert(customtkinter.END, "Please enter a Project ID.\n")
@@ -106,6 +127,7 @@ class App:
         self.update_button.configure(
             state=customtkinter.DISABLED
         )  # Disable update button during update
+        self.verify_button.configure(state=customtkinter.DISABLED)
         self.project_name_label.configure(text="Project Name: - ")
         self.file_size_label.configure(text="File Size: - ")
         self.download_speed_label.configure(text="Download Speed: - ")
@@ -117,8 +139,12 @@ class App:
         self.fetch_project_info()
 
         # Start update process in a separate thread
-        update_thread = threading.Thread(target=self.update_game_files_threaded)
-        update_thread.start()
+        self.progress = DownloadProgress()
+        self.last_sample = None
+        self.smoothed_speed = 0
+        self.update_thread = threading.Thread(target=self.update_game_files_threaded, args=(verify_all,))
+        self.update_thread.start()
+        self.root.after(PROGRESS_INTERVAL, self.poll_progress)
 
     def animate_loading(self):
         self.loading_label.configure(
@@ -129,39 +155,33 @@ class App:
         )
         self.root.after(self.loading_animation_interval, self.animate_loading)
 
+    def manifest_cache_path(self):
+        return os.path.join(self.local_dir, ".manifests", f"{self.project}.json")
+
     def fetch_project_info(self):
         try:
-            response = requests.get(f"{SERVER_URL}/files_info/{self.project}/")
-            if response.status_code == 200:
-                info = response.json()
-                project_name = info.get("project_name", "Unknown")
-                self.project_name_label.configure(text=f"Project Name: {project_name}")
-            else:
-                self.text_area.insert(
-                    customtkinter.END,
-                    f"Error fetching project information: {response.status_code}\n",
-                )
+            project_name = fetch_project_name(SERVER_URL, self.project, self.manifest_cache_path())
+            self.project_name_label.configure(text=f"Project Name: {project_name}")
         except Exception as e:
             self.text_area.insert(customtkinter.END, f"An error occurred: {str(e)}\n")
 
-    def update_game_files_threaded(self):
+    def update_game_files_threaded(self, verify_all):
         try:
-            response = requests.get(f"{SERVER_URL}/files_info/{self.project}/")
-            if response.status_code == 200:
-                files_info = response.json()
-                self.project_name = files_info.get("project_name", "Unknown")
-                self.update_game_files(files_info)
-                self.text_area.insert(customtkinter.END, "\nUpdate complete.\n")
-                self.text_area.see(customtkinter.END)
-                self.text_area.update_idletasks()
-            else:
-                self.text_area.insert(
-                    customtkinter.END,
-                    f"Error fetching files information: {response.status_code}\n",
-                )
+            # Only the changes since the cached manifest cross the network, a first
+            # update streams the manifest page by page and downloads while it arrives
+            files_info, _ = sync_project(
+                SERVER_URL,
+                self.project,
+                self.local_dir,
+                log=self.log,
+                progress=self.progress,
+                verify_all=verify_all,
+            )
+            self.project_name = files_info.get("project_name", "Unknown")
+            self.log("\nUpdate complete.")
         except Exception as e:
-            self.text_area.insert(customtkinter.END, f"An error occurred: {str(e)}\n")
-        
+            self.log(f"An error occurred: {str(e)}")
+
         # in script path write to projects_list.json
         projects_list = {}
         if not os.path.exists("projects_list.json"):
@@ -171,94 +191,50 @@ class App:
         projects_list[self.project_name] = self.project
         with open("projects_list.json", "w") as f:
             json.dump(projects_list, f, indent=4)
-        self.update_button.configure(
-            state=customtkinter.NORMAL
-        )  # Re-enable update button after update
-        self.loading_label.configure(text="")
-
-    def update_game_files(self, files_info):
-        project_name = files_info.get("project_name", "Unknown")
-        project_dir = os.path.join(self.local_dir, project_name)
-        completed_files_path = os.path.join(project_dir, "completed_files.json")
-
-        if not os.path.exists(project_dir):
-            os.makedirs(project_dir, exist_ok=True)
-
-        self.completed_files = self.load_completed_files(completed_files_path)
-
-        for file_name, file_info in files_info["files"].items():
-            local_file_dir = os.path.join(project_dir, os.path.dirname(file_name))
-            if not os.path.exists(local_file_dir):
-                os.makedirs(local_file_dir, exist_ok=True)
-
-            local_file_path = os.path.join(project_dir, file_name)
-            server_checksum = file_info.get("checksum")
-            local_checksum = self.completed_files.get(file_name)
-
-            if local_checksum and local_checksum == server_checksum:
-                self.text_area.insert(customtkinter.END, f"{file_name} is up to date.\n")
-                continue
-
-            try:
-                file_size = file_info.get("size", 0)
-                self.download_file_with_speed(
-                    f"{SERVER_URL}/files/",
-                    {"project": self.project, "filename": file_name},
-                    local_file_path,
-                    file_size,
-                )
-                self.completed_files[file_name] = server_checksum
-                self.save_completed_files(completed_files_path)
-                self.text_area.insert(customtkinter.END, f"Downloaded {file_name}\n")
-                self.text_area.see(customtkinter.END)
-                self.text_area.update_idletasks()
-            except Exception as e:
-                self.text_area.insert(
-                    customtkinter.END, f"Error downloading {file_name}: {str(e)}\n"
-                )
-                self.text_area.see(customtkinter.END)
-                self.text_area.update_idletasks()
-
-    def download_file_with_speed(self, url, data, local_file_path, file_size):
-        response = requests.post(url, json=data, stream=True)
-        total_length = int(response.headers.get("content-length", 0))
-
-        start_time = time.time()
-        downloaded = 0
-
-        with open(local_file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=16384):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-
-                    # Calculate download speed
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time != 0:
-                        download_speed = downloaded / (
-                            1024 * 1024 * elapsed_time
-                        )  # MB/s
-                    else:
-                        download_speed = 0  # or some other value that makes sense in your context
-                    self.download_speed_label.configure(
-                        text=f"Download Speed: {download_speed:.2f} MB/s"
-                    )
-                    self.file_size_label.configure(
-                        text=f"File Size: {downloaded/(1024*1024):.2f} MB / {(total_length / (1024 * 1024)):.2f} MB"
-                    )
-                    # Update UI
-                    self.root.update_idletasks()
-            self.root.update_idletasks()
-
-    def load_completed_files(self, path):
-        if os.path.exists(path):
-            with open(path, "r") as f:
-                return json.load(f)
-        return {}
-
-    def save_completed_files(self, path):
-        with open(path, "w") as f:
-            json.dump(self.completed_files, f, indent=4)
+
+    def log(self, message):
+        self.messages.put(message)
+
+    def poll_progress(self):
+        lines = []
+        while not self.messages.empty():
+            lines.append(self.messages.get_nowait())
+        if lines:
+            self.text_area.insert(customtkinter.END, "".join(f"{line}\n" for line in lines))
+            self.text_area.see(customtkinter.END)
+
+        downloaded, total, _ = self.progress.snapshot()
+        now = time.time()
+        if self.last_sample is not None:
+            last_time, last_downloaded = self.last_sample
+            if now > last_time:
+                # Exponential moving average keeps the readout steady between ticks
+                speed = max(downloaded - last_downloaded, 0) / (now - last_time)
+                self.smoothed_speed = 0.3 * speed + 0.7 * self.smoothed_speed
+        self.last_sample = (now, downloaded)
+
+        remaining = max(total - downloaded, 0)
+        if self.smoothed_speed > 0 and remaining:
+            eta = str(datetime.timedelta(seconds=int(remaining / self.smoothed_speed)))
+        else:
+            eta = "-"
+        self.download_speed_label.configure(
+            text=f"Download Speed: {self.smoothed_speed / (1024 * 1024):.2f} MB/s (ETA {eta})"
+        )
+        self.file_size_label.configure(
+            text=f"File Size: {downloaded/(1024*1024):.2f} MB / {(total / (1024 * 1024)):.2f} MB"
+        )
+
+        if self.update_thread is not None and self.update_thread.is_alive():
+            self.root.after(PROGRESS_INTERVAL, self.poll_progress)
+        elif not self.messages.empty():
+            self.root.after(0, self.poll_progress)
+        else:
+            self.update_button.configure(
+                state=customtkinter.NORMAL
+            )  # Re-enable update button after update
+            self.verify_button.configure(state=customtkinter.NORMAL)
+            self.loading_label.configure(text="")
 
     def check_server_status(self):
         try:
@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS") or 0) or min(8, os.cpu_count() or 1)
+HASH_BUFFER_SIZE = int(os.getenv("HASH_BUFFER_SIZE") or 0) or 8 * 1024 * 1024
+
+TREE_HASH_ALGORITHM = "sha256-tree"
+
+# Manifest entries may carry "hash_algorithm": "sha256-tree" with "hash_chunk_size": the checksum
+# is then the sha256 of the concatenated sha256 digests of consecutive chunks of that size
+def algorithm_id(file_info):
+    if file_info and file_info.get("hash_algorithm") == TREE_HASH_ALGORITHM:
+        return f"{TREE_HASH_ALGORITHM}/{file_info['hash_chunk_size']}"
+    return "sha256"
+
+# Streaming form of the tree hash for data that arrives in order (downloads, patched files)
+class TreeHasher:
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunk = hashlib.sha256()
+        self.filled = 0
+        self.digests = []
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.chunk_size - self.filled)
+            self.chunk.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.chunk_size:
+                self.digests.append(self.chunk.digest())
+                self.chunk = hashlib.sha256()
+                self.filled = 0
+
+    def hexdigest(self):
+        digests = self.digests + [self.chunk.digest()] if self.filled else self.digests
+        return hashlib.sha256(b"".join(digests)).hexdigest()
+
+def new_hasher(file_info):
+    if algorithm_id(file_info) != "sha256":
+        return TreeHasher(file_info["hash_chunk_size"])
+    return hashlib.sha256()
+
+def hash_range(file_path, start, length, buffer_size=HASH_BUFFER_SIZE):
+    # One reusable buffer and large reads; hashlib drops the GIL, so a thread pool hashes in parallel
+    sha256 = hashlib.sha256()
+    buffer = bytearray(min(buffer_size, length))
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        f.seek(start)
+        while length > 0:
+            size = f.readinto(view[:min(len(buffer), length)])
+            if not size:
+                break
+            length -= size
+            sha256.update(view[:size])
+    return sha256.digest()
+
+def hash_file(file_path, file_info=None, chunk_pool=None):
+    size = os.path.getsize(file_path)
+    if algorithm_id(file_info) == "sha256":
+        return hash_range(file_path, 0, size).hex()
+    # Tree hash chunks are independent, with a pool one huge file is hashed on every core
+    chunk_size = file_info["hash_chunk_size"]
+    starts = range(0, size, chunk_size)
+    if chunk_pool is None:
+        digests = [hash_range(file_path, start, min(chunk_size, size - start)) for start in starts]
+    else:
+        digests = chunk_pool.map(lambda start: hash_range(file_path, start, min(chunk_size, size - start)), starts)
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+def stat_key(stat):
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+# Verified checksum of every installed file, keyed by (size, mtime_ns, inode) and the hash
+# algorithm. A file whose stat still matches its entry is trusted without reading it, anything
+# else is rehashed. It is only a cache: an unreadable file starts an empty index, which costs a
+# rehash, and saves atomically replace it so a crash leaves the previous one.
+class IntegrityIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, file_name, stat, algorithm="sha256"):
+        entry = self.entries.get(file_name)
+        if entry is not None and entry["stat"] == stat_key(stat) and entry.get("algorithm", "sha256") == algorithm:
+            return entry["checksum"]
+        return None
+
+    def record(self, file_name, stat, checksum, algorithm="sha256"):
+        with self.lock:
+            entry = {"stat": stat_key(stat), "checksum": checksum}
+            if algorithm != "sha256":
+                entry["algorithm"] = algorithm
+            self.entries[file_name] = entry
+
+    def forget(self, file_name):
+        with self.lock:
+            self.entries.pop(file_name, None)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries, separators=(",", ":"))
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    # files maps names to manifest entries, which choose the hash algorithm.
+    # Returns {file_name: checksum or None when missing}; full=True ignores the stat short-circuit
+    def verify(self, project_dir, files, full=False, workers=HASH_WORKERS):
+        checksums = {}
+        to_hash = []
+        for file_name, file_info in files.items():
+            local_file_path = os.path.join(project_dir, file_name)
+            try:
+                stat = os.stat(local_file_path)
+            except FileNotFoundError:
+                checksums[file_name] = None
+                self.forget(file_name)
+                continue
+            checksum = None if full else self.lookup(file_name, stat, algorithm_id(file_info))
+            if checksum is None:
+                to_hash.append(file_name)
+            else:
+                checksums[file_name] = checksum
+
+        def rehash(file_name):
+            local_file_path = os.path.join(project_dir, file_name)
+            file_info = files[file_name]
+            # Stat before reading, a change during hashing then shows up on the next run
+            try:
+                stat = os.stat(local_file_path)
+                checksum = hash_file(local_file_path, file_info, chunk_pool)
+            except OSError:
+                self.forget(file_name)
+                return None
+            self.record(file_name, stat, checksum, algorithm_id(file_info))
+            return checksum
+
+        # Tree hash chunks get their own pool, file workers waiting on them cannot starve it
+        with ThreadPoolExecutor(max_workers=workers) as chunk_pool, ThreadPoolExecutor(max_workers=workers) as pool:
+            for file_name, checksum in zip(to_hash, pool.map(rehash, to_hash)):
+                checksums[file_name] = checksum
+        return checksums
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+
+JOURNAL_BATCH_SIZE = 256
+JOURNAL_BATCH_INTERVAL = 1.0  # in seconds
+JOURNAL_COMPACT_ENTRIES = 65536
+
+# completed_files.json plus an append-only journal of changes made since it was written.
+# Updates are buffered and appended (and fsynced) in batches; compaction folds the journal
+# back into a fresh snapshot that atomically replaces the old one. A torn last journal line
+# from a crash is skipped on load, so at most the last unflushed batch is lost.
+class CompletedFiles:
+    def __init__(self, project_dir):
+        self.snapshot_path = os.path.join(project_dir, "completed_files.json")
+        self.journal_path = os.path.join(project_dir, "completed_files.journal")
+        self.lock = threading.Lock()
+        self.files = {}
+        self.buffer = []
+        self.journal_entries = 0
+        self.last_flush = time.time()
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                self.files = json.load(f)
+        if os.path.exists(self.journal_path):
+            valid_length = 0
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        file_name, checksum = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self.files[file_name] = checksum
+                    self.journal_entries += 1
+                    valid_length += len(line)
+            # Cut off a torn tail so new entries start on a clean line
+            if valid_length < os.path.getsize(self.journal_path):
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(valid_length)
+        self.journal = open(self.journal_path, "a")
+
+    def get(self, file_name):
+        return self.files.get(file_name)
+
+    def set(self, file_name, checksum):
+        with self.lock:
+            self.files[file_name] = checksum
+            self.buffer.append(json.dumps([file_name, checksum]) + "\n")
+            if len(self.buffer) >= JOURNAL_BATCH_SIZE or time.time() - self.last_flush >= JOURNAL_BATCH_INTERVAL:
+                self.flush_locked()
+            if self.journal_entries >= JOURNAL_COMPACT_ENTRIES:
+                self.compact_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        self.journal.write("".join(self.buffer))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_entries += len(self.buffer)
+        self.buffer.clear()
+
+    def compact(self):
+        with self.lock:
+            self.compact_locked()
+
+    def compact_locked(self):
+        self.flush_locked()
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.files, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        # A crash before the truncate only replays entries the snapshot already holds
+        self.journal.truncate(0)
+        self.journal_entries = 0
+
+    def close(self):
+        # Compact once the journal outgrows the snapshot it applies to
+        if self.journal_entries + len(self.buffer) > max(JOURNAL_BATCH_SIZE, len(self.files) // 4):
+            self.compact()
+        else:
+            self.flush()
+        self.journal.close()
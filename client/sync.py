@@ -0,0 +1,247 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from blobs import BlobCache
+from downloader import Downloader
+from integrity import IntegrityIndex, algorithm_id
+from state import CompletedFiles
+
+MANIFEST_HEADER_KEYS = ("version", "project_name", "revision", "blob_store")
+
+def load_cached_manifest(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def save_cached_manifest(cache_path, files_info):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(files_info, f, separators=(",", ":"))
+    os.replace(temp_path, cache_path)
+
+# Folds a diff from the server into the manifest it was made against, in place
+def apply_manifest_diff(files_info, diff):
+    for file_name in diff["removed"]:
+        files_info["files"].pop(file_name, None)
+    files_info["files"].update(diff["added"])
+    files_info["files"].update(diff["changed"])
+    for key in MANIFEST_HEADER_KEYS:
+        files_info[key] = diff[key]
+    return files_info
+
+# The last manifest is kept at cache_path; with it only the changes since its revision are asked
+# for, and the server answers with the full manifest whenever it cannot produce them.
+def fetch_files_info(server_url, project, cache_path):
+    cached = load_cached_manifest(cache_path)
+
+    if cached is not None and "revision" in cached:
+        response = requests.get(f"{server_url}/files_info/{project}/since/{cached['revision']}/")
+    else:
+        response = requests.get(f"{server_url}/files_info/{project}/")
+    response.raise_for_status()
+    files_info = response.json()
+
+    if "since" in files_info:
+        if files_info["since"] != cached["revision"]:
+            raise ValueError(f"Manifest diff since revision {files_info['since']} does not apply to {cached['revision']}")
+        files_info = apply_manifest_diff(cached, files_info)
+
+    save_cached_manifest(cache_path, files_info)
+    return files_info
+
+# One page of the paged manifest, parsed line by line as it arrives: (header, {path: entry})
+def fetch_manifest_page(session, server_url, project, page):
+    with session.get(f"{server_url}/files_info/{project}/", params={"page": page}, stream=True) as response:
+        response.raise_for_status()
+        lines = response.iter_lines()
+        header = json.loads(next(lines))
+        files = {}
+        for line in lines:
+            if line:
+                file_name, file_info = json.loads(line)
+                files[file_name] = file_info
+    return header, files
+
+# Yields (header, files) per manifest page; the next page is fetched while the caller works on
+# the current one. Every page must come from the same generation, a manifest republished
+# midway raises ValueError. A server without a paged manifest raises HTTPError 404 on the first
+def iter_manifest_pages(server_url, project):
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=1) as prefetch:
+        header, files = fetch_manifest_page(session, server_url, project, 0)
+        generation = header["generation"]
+        for page in range(header["pages"] or 1):
+            upcoming = None
+            if page + 1 < header["pages"]:
+                upcoming = prefetch.submit(fetch_manifest_page, session, server_url, project, page + 1)
+            yield header, files
+            if upcoming is None:
+                break
+            header, files = upcoming.result()
+            if header["generation"] != generation:
+                raise ValueError("The manifest changed on the server while it was being read")
+
+# Name of the project's directory under the install directory, without fetching the whole manifest
+def fetch_project_name(server_url, project, cache_path):
+    cached = load_cached_manifest(cache_path)
+    if cached is not None:
+        return cached.get("project_name", "Unknown")
+    with requests.Session() as session:
+        try:
+            header, _ = fetch_manifest_page(session, server_url, project, 0)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            return fetch_files_info(server_url, project, cache_path).get("project_name", "Unknown")
+    return header.get("project_name", "Unknown")
+
+# Brings a local project directory in line with its manifest, one batch of entries at a time, so
+# a manifest that arrives in pages is worked on while the rest is still on its way. It reports only
+# through the log callback and the progress counters, so the Tk App and headless callers share it.
+# With blob_cache_dir, files any project there already has are copied instead of downloaded.
+class ProjectUpdater:
+    def __init__(self, server_url, project, project_dir, log, progress=None, verify_all=False,
+                 blob_cache_dir=None, blob_store=False):
+        self.project_dir = project_dir
+        self.log = log
+        self.verify_all = verify_all
+        os.makedirs(project_dir, exist_ok=True)
+
+        self.files = {}
+        self.completed_files = CompletedFiles(project_dir)
+        self.integrity_index = IntegrityIndex(os.path.join(project_dir, "integrity_index.json"))
+        self.blob_cache = BlobCache(blob_cache_dir) if blob_cache_dir else None
+        self.downloader = Downloader(
+            server_url, project, log=log, on_complete=self.mark_completed, progress=progress, blob_store=blob_store,
+        )
+
+    def mark_completed(self, file_name, checksum):
+        self.completed_files.set(file_name, checksum)
+        # Installed files were hashed while they were written, index them as verified
+        try:
+            stat = os.stat(os.path.join(self.project_dir, file_name))
+        except OSError:
+            self.integrity_index.forget(file_name)
+            return
+        algorithm = algorithm_id(self.files[file_name])
+        self.integrity_index.record(file_name, stat, checksum, algorithm)
+        if self.blob_cache is not None:
+            self.blob_cache.add(checksum, os.path.join(self.project_dir, file_name), stat, algorithm)
+
+    # files maps names to manifest entries; returns the entries that had to be downloaded
+    def update(self, files):
+        self.files.update(files)
+        # Files whose stat matches the index are trusted, the rest are rehashed in parallel
+        if self.verify_all:
+            self.log("Verifying all files...")
+        local_checksums = self.integrity_index.verify(self.project_dir, files, full=self.verify_all)
+        self.integrity_index.save()
+
+        pending = []
+        for file_name, file_info in files.items():
+            local_file_dir = os.path.join(self.project_dir, os.path.dirname(file_name))
+            if not os.path.exists(local_file_dir):
+                os.makedirs(local_file_dir, exist_ok=True)
+
+            server_checksum = file_info.get("checksum")
+            local_checksum = local_checksums.get(file_name)
+
+            if local_checksum and local_checksum == server_checksum:
+                self.log(f"{file_name} is up to date.")
+                # Files installed before the cache existed seed it for the other projects
+                if self.blob_cache is not None:
+                    local_file_path = os.path.join(self.project_dir, file_name)
+                    try:
+                        self.blob_cache.add(
+                            server_checksum, local_file_path, os.stat(local_file_path), algorithm_id(file_info)
+                        )
+                    except OSError:
+                        pass
+                continue
+            if local_checksum and self.completed_files.get(file_name) == server_checksum:
+                self.log(f"{file_name} is modified or corrupted, downloading it again")
+            if self.blob_cache is not None and self.blob_cache.install(
+                server_checksum, os.path.join(self.project_dir, file_name), file_info
+            ):
+                self.mark_completed(file_name, server_checksum)
+                self.log(f"Copied {file_name} from the blob cache")
+                continue
+            pending.append((file_name, file_info))
+
+        self.downloader.download_files(pending, self.project_dir)
+        return pending
+
+    def close(self):
+        self.downloader.close()
+        self.completed_files.close()
+        self.integrity_index.save()
+        if self.blob_cache is not None:
+            self.blob_cache.save()
+
+def update_project_files(server_url, project, files_info, project_dir, log, progress=None, verify_all=False,
+                         blob_cache_dir=None):
+    updater = ProjectUpdater(
+        server_url, project, project_dir, log, progress=progress, verify_all=verify_all,
+        blob_cache_dir=blob_cache_dir, blob_store=files_info.get("blob_store", False),
+    )
+    try:
+        return updater.update(files_info["files"])
+    finally:
+        updater.close()
+
+# Updates project into <local_dir>/<project name>, keeping its manifest in <local_dir>/.manifests/
+# and the shared blob cache in <local_dir>/.blobs/. With a cached manifest only the changes since
+# its revision are fetched; without one the paged manifest is streamed and every page is checked
+# and downloaded as it arrives. Returns (files_info, pending)
+def sync_project(server_url, project, local_dir, log, progress=None, verify_all=False):
+    cache_path = os.path.join(local_dir, ".manifests", f"{project}.json")
+    blob_cache_dir = os.path.join(local_dir, ".blobs")
+
+    pages = None
+    if load_cached_manifest(cache_path) is None:
+        pages = iter_manifest_pages(server_url, project)
+        try:
+            header, files = next(pages)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            pages = None
+
+    if pages is None:
+        files_info = fetch_files_info(server_url, project, cache_path)
+        project_dir = os.path.join(local_dir, files_info.get("project_name", "Unknown"))
+        pending = update_project_files(
+            server_url, project, files_info, project_dir, log, progress=progress, verify_all=verify_all,
+            blob_cache_dir=blob_cache_dir,
+        )
+        return files_info, pending
+
+    files_info = {key: header[key] for key in MANIFEST_HEADER_KEYS}
+    files_info["files"] = {}
+    updater = ProjectUpdater(
+        server_url, project, os.path.join(local_dir, header["project_name"]), log, progress=progress,
+        verify_all=verify_all, blob_cache_dir=blob_cache_dir, blob_store=header["blob_store"],
+    )
+    pending = []
+    try:
+        while True:
+            log(f"Manifest page {header['page'] + 1} of {max(header['pages'], 1)}")
+            pending += updater.update(files)
+            files_info["files"].update(files)
+            try:
+                header, files = next(pages)
+            except StopIteration:
+                break
+    finally:
+        pages.close()
+        updater.close()
+    # Only a complete manifest is cached, the next run then asks for changes since its revision
+    save_cached_manifest(cache_path, files_info)
+    return files_info, pending
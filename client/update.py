@@ -1,10 +1,15 @@
 import os
 import sys
+import json
+import lzma
+import struct
 import requests
 import shutil
 import tempfile
 import subprocess
 import hashlib
+import random
+import time
 
 import dotenv
 dotenv.load_dotenv()
@@ -12,25 +17,55 @@ dotenv.load_dotenv()
 SERVER_URL = os.getenv("API_URL")
 UPDATE_INFO_URL = f"{SERVER_URL}/update_info/"
 UPDATE_FILE_URL = f"{SERVER_URL}/download_update/"
+UPDATE_PATCH_URL = f"{SERVER_URL}/download_update/patch/"
+EXECUTABLE_NAME = "game_updater.exe"
+# Must match tools/publish_update.py
+PATCH_MAGIC = b"CPPATCH1"
+COPY_CHUNK_SIZE = 1024 * 1024
+# Times a busy server (503 with Retry-After) is asked again before giving up
+BUSY_RETRIES = 30
+
+def get_exe_path():
+    exe_dir = os.path.dirname(sys.executable)
+    return os.path.join(exe_dir, EXECUTABLE_NAME)
+
+def version_cache_path(exe_path):
+    return os.path.splitext(exe_path)[0] + ".version.json"
+
+def stat_key(exe_path):
+    stat = os.stat(exe_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def save_version(exe_path, version):
+    try:
+        with open(version_cache_path(exe_path), "w") as f:
+            json.dump({"stat": stat_key(exe_path), "version": version}, f)
+    except OSError as e:
+        print(f"Error saving version cache: {e}")
 
 def get_current_version():
-    # Generate checksum of the current executable
+    # Checksum of the current executable, cached next to it until its size or mtime changes
     try:
-        exe_dir = os.path.dirname(sys.executable)
-        exe_path = os.path.join(exe_dir, 'game_updater.exe')
+        exe_path = get_exe_path()
         print(f"Exe path: {exe_path}")
+        try:
+            with open(version_cache_path(exe_path), "r") as f:
+                cached = json.load(f)
+            if cached.get("stat") == stat_key(exe_path):
+                return cached["version"]
+        except (OSError, ValueError):
+            pass
         checksum = hashlib.md5()
-        with open(exe_path , "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+        with open(exe_path, "rb") as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
                 checksum.update(chunk)
-            f.close()
+        save_version(exe_path, checksum.hexdigest())
         return checksum.hexdigest()
     except Exception as e:
         print(f"Error getting current version: {e}")
     return None
 
-def check_for_update():
-    current_version = get_current_version()
+def check_for_update(current_version):
     print(f"Current version: {current_version}")
     try:
         response = requests.get(UPDATE_INFO_URL)
@@ -39,34 +74,118 @@ def check_for_update():
             latest_version = update_info.get('version')
             print(f"Latest version: {latest_version}")
             if latest_version != current_version:
-                return latest_version
+                return update_info
     except Exception as e:
         print(f"Error checking for update: {e}")
     return None
 
-def download_update():
+def verify_update(file_path, update_info):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    expected = update_info.get("files", {}).get(EXECUTABLE_NAME, {}).get("checksum")
+    if md5.hexdigest() != update_info.get("version") or (expected and sha256.hexdigest() != expected):
+        raise IOError("Downloaded update does not match the server checksum")
+
+def download_to_temp(url):
+    for _ in range(BUSY_RETRIES):
+        response = requests.get(url, stream=True)
+        retry_after = response.headers.get("Retry-After", "")
+        if response.status_code != 503 or not retry_after.isdigit():
+            break
+        response.close()
+        delay = int(retry_after) * (1 + random.random())
+        print(f"Server busy, retrying in {delay:.1f}s")
+        time.sleep(delay)
+    response.raise_for_status()
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+        for chunk in response.iter_content(chunk_size=COPY_CHUNK_SIZE):
+            tmp_file.write(chunk)
+    return tmp_file.name
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise IOError("Patch ended unexpectedly")
+    return data
+
+def copy_stream(source, target, length):
+    while length > 0:
+        chunk = source.read(min(length, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise IOError("Patch refers past the end of its input")
+        target.write(chunk)
+        length -= len(chunk)
+
+def apply_patch(old_path, patch_path, target_path):
+    with open(patch_path, "rb") as patch, open(old_path, "rb") as old, open(target_path, "wb") as target:
+        if patch.read(len(PATCH_MAGIC)) != PATCH_MAGIC:
+            raise IOError("Not an update patch")
+        (target_size,) = struct.unpack(">Q", read_exactly(patch, 8))
+        with lzma.open(patch, "rb") as operations:
+            while True:
+                operation = read_exactly(operations, 1)
+                if operation == b"C":
+                    offset, length = struct.unpack(">QQ", read_exactly(operations, 16))
+                    old.seek(offset)
+                    copy_stream(old, target, length)
+                elif operation == b"I":
+                    (length,) = struct.unpack(">Q", read_exactly(operations, 8))
+                    copy_stream(operations, target, length)
+                elif operation == b"E":
+                    break
+                else:
+                    raise IOError(f"Unknown patch operation {operation!r}")
+        if target.tell() != target_size:
+            raise IOError("Patched executable has the wrong size")
+
+def download_patch(current_version, update_info):
+    patch_file = None
     try:
-        response = requests.get(f"{UPDATE_FILE_URL}", stream=True)
-        if response.status_code == 200:
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    tmp_file.write(chunk)
-            return tmp_file.name
+        patch_file = download_to_temp(f"{UPDATE_PATCH_URL}{current_version}/")
+        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+            pass
+        try:
+            apply_patch(get_exe_path(), patch_file, tmp_file.name)
+            verify_update(tmp_file.name, update_info)
+        except Exception:
+            os.remove(tmp_file.name)
+            raise
+        return tmp_file.name
+    except Exception as e:
+        print(f"Error applying update patch: {e}")
+    finally:
+        if patch_file is not None and os.path.exists(patch_file):
+            os.remove(patch_file)
+    return None
+
+def download_update(update_info):
+    update_file = None
+    try:
+        update_file = download_to_temp(UPDATE_FILE_URL)
+        verify_update(update_file, update_info)
+        return update_file
     except Exception as e:
         print(f"Error downloading update: {e}")
+        if update_file is not None and os.path.exists(update_file):
+            os.remove(update_file)
     return None
 
-def replace_executable(update_file):
+def replace_executable(update_file, version):
     try:
-        exe_dir = os.path.dirname(sys.executable)
-        exe_path = os.path.join(exe_dir, 'game_updater.exe')
+        exe_path = get_exe_path()
         backup_path = exe_path + ".bak"
-        
+
         if os.path.exists(backup_path):
             os.remove(backup_path)
         os.rename(exe_path, backup_path)
         shutil.move(update_file, exe_path)
         os.chmod(exe_path, 0o755)
+        # The new executable is already verified, the next launch need not hash it again
+        save_version(exe_path, version)
         print("Update successful. Restarting application.")
         subprocess.Popen([exe_path] + sys.argv[1:])
         sys.exit(0)
@@ -76,14 +195,20 @@ def replace_executable(update_file):
             os.remove(update_file)
 
 def main():
-    exe_dir = os.path.dirname(sys.executable)
-    exe_path = os.path.join(exe_dir, 'game_updater.exe')
-    latest_version = check_for_update()
-    if latest_version:
+    exe_path = get_exe_path()
+    current_version = get_current_version()
+    update_info = check_for_update(current_version)
+    if update_info:
+        latest_version = update_info.get("version")
         print(f"New version available: {latest_version}")
-        update_file = download_update()
+        update_file = None
+        # A patch from this exact version is a fraction of the executable, fall back to the full download
+        if current_version in update_info.get("patches", {}):
+            update_file = download_patch(current_version, update_info)
+        if update_file is None:
+            update_file = download_update(update_info)
         if update_file:
-            replace_executable(update_file)
+            replace_executable(update_file, latest_version)
     else:
         subprocess.Popen([exe_path] + sys.argv[1:])
         print("No update available.")
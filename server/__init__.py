@@ -1,7 +1,27 @@
 from flask import Flask, jsonify, abort, request, Response
 import os
+import re
+import sys
 import json
+import time
+import signal
+import bisect
 import hashlib
+import gzip
+import tarfile
+import threading
+import traceback
+from werkzeug.http import http_date, parse_accept_header, parse_etags, parse_range_header, parse_if_range_header
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
 
 import dotenv
 dotenv.load_dotenv()
@@ -10,6 +30,38 @@ app = Flask(__name__)
 FILES_DIR = os.getenv("FILES_DIR") or ""
 PROJECT_DATA = json.loads(open(f'{os.getenv("PROJECT_DATA")}', "r").read())
 PORT = int(os.getenv("PORT") or "") or 5000
+ZERO_COPY = (os.getenv("ZERO_COPY") or "1") != "0"
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE") or 0) or 256 * 1024
+BUNDLE_MAX_FILES = int(os.getenv("BUNDLE_MAX_FILES") or 0) or 1024
+BUNDLE_MAX_FILE_SIZE = int(os.getenv("BUNDLE_MAX_FILE_SIZE") or 0) or 4 * 1024 * 1024
+# Pre-compressed sidecars written by tools/generate_files_info.py with COMPRESS=1
+COMPRESSED_DIR = ".compressed"
+ENCODING_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+# /blobs/<sha256> serves any project file with that checksum, see BlobIndex
+BLOB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Paged NDJSON copy of files_info.json, see MANIFEST_DIR in tools/generate_files_info.py
+MANIFEST_DIR = ".manifest"
+# PROFILE_INTERVAL (seconds) starts a sampling profiler whose stacks are served at /debug/profile/
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL") or 0)
+# The PROJECT_DATA file is checked for changes every PROJECT_DATA_POLL_INTERVAL seconds once start_project_data_watcher() ran
+PROJECT_DATA_POLL_INTERVAL = float(os.getenv("PROJECT_DATA_POLL_INTERVAL") or 0) or 2.0
+# Admission control for file streams: at most MAX_STREAMS at once and MAX_CLIENT_STREAMS per client
+# address, anything over is answered 503 with Retry-After: RETRY_AFTER. Manifest, status and metrics
+# requests are never limited; under a WSGI server keep MAX_STREAMS below its thread count so they
+# always find a free worker. STREAM_RATE_LIMIT caps every stream in bytes/s and TOTAL_RATE_LIMIT
+# is split evenly between the running streams
+MAX_STREAMS = int(os.getenv("MAX_STREAMS") or 0) or 256
+MAX_CLIENT_STREAMS = int(os.getenv("MAX_CLIENT_STREAMS") or 0) or 16
+RETRY_AFTER = int(os.getenv("RETRY_AFTER") or 0) or 5
+STREAM_RATE_LIMIT = int(os.getenv("STREAM_RATE_LIMIT") or 0)
+TOTAL_RATE_LIMIT = int(os.getenv("TOTAL_RATE_LIMIT") or 0)
+STREAM_PATHS = ("/files/", "/bundle/", "/blocks/", "/blobs/", "/download_update/")
+# Reverse proxies in front of the server (a TLS terminator, a load balancer). With TRUSTED_PROXIES
+# set, the per-client limit is keyed on the address the outermost of them put in X-Forwarded-For;
+# without it every player behind a proxy shares the proxy's address, and with it MAX_CLIENT_STREAMS.
+# Only set it when clients cannot reach the server directly, they could then claim any address.
+# Players behind one carrier NAT share an address either way
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES") or 0)
 
 if not FILES_DIR and FILES_DIR is not None and not os.path.exists(FILES_DIR):
     raise ValueError("FILES_DIR is not set in .env")
@@ -34,11 +86,491 @@ def add_security_headers(response):
     response.headers["Content-Security-Policy"] = csp_header
     return response
 
-def file_generator(file_path, chunk_size=8192):
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def prometheus_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_labels(**labels):
+    return "{" + ",".join(f'{name}="{prometheus_label_value(value)}"' for name, value in labels.items()) + "}"
+
+# Request, stream, cache and timing counters rendered in the Prometheus text format at /metrics.
+# Everything is a plain dict behind one lock and a request updates it once when it finishes,
+# which keeps the overhead to a few microseconds per request.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.bytes_sent = {}
+        self.active_streams = 0
+        self.streams = 0
+        self.caches = {}
+        self.timings = {}
+        self.rejected = {}
+
+    def observe_request(self, route, method, status, seconds, project=None, sent=0):
+        with self.lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            if sent:
+                self.bytes_sent[project] = self.bytes_sent.get(project, 0) + sent
+
+    def stream_started(self):
+        with self.lock:
+            self.active_streams += 1
+            self.streams += 1
+
+    def stream_finished(self):
+        with self.lock:
+            self.active_streams -= 1
+
+    def stream_rejected(self, scope):
+        with self.lock:
+            self.rejected[scope] = self.rejected.get(scope, 0) + 1
+
+    def cache_access(self, cache, hit):
+        with self.lock:
+            counts = self.caches.setdefault(cache, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    # Time spent in expensive steps such as parsing and compressing manifests or hashing
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    def render(self):
+        with self.lock:
+            lines = [
+                "# HELP content_server_requests_total Finished requests by route, method and status",
+                "# TYPE content_server_requests_total counter",
+            ]
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f"content_server_requests_total{prometheus_labels(route=route, method=method, status=status)} {count}")
+
+            lines += [
+                "# HELP content_server_request_duration_seconds Time from receiving a request to sending its last byte",
+                "# TYPE content_server_request_duration_seconds histogram",
+            ]
+            for route, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram):
+                    cumulative += count
+                    lines.append(
+                        f"content_server_request_duration_seconds_bucket{prometheus_labels(route=route, le=bound)} {cumulative}"
+                    )
+                lines.append(f"content_server_request_duration_seconds_sum{prometheus_labels(route=route)} {histogram[-1]}")
+                lines.append(f"content_server_request_duration_seconds_count{prometheus_labels(route=route)} {cumulative}")
+
+            lines += [
+                "# HELP content_server_sent_bytes_total Response body bytes by project",
+                "# TYPE content_server_sent_bytes_total counter",
+            ]
+            for project, sent in sorted(self.bytes_sent.items(), key=lambda item: str(item[0])):
+                lines.append(f"content_server_sent_bytes_total{prometheus_labels(project=project or '')} {sent}")
+
+            lines += [
+                "# HELP content_server_active_streams Streamed responses currently being sent",
+                "# TYPE content_server_active_streams gauge",
+                f"content_server_active_streams {self.active_streams}",
+                "# HELP content_server_streams_total Streamed responses started",
+                "# TYPE content_server_streams_total counter",
+                f"content_server_streams_total {self.streams}",
+                "# HELP content_server_rejected_streams_total Streams refused with 503 by the limit that was reached",
+                "# TYPE content_server_rejected_streams_total counter",
+            ]
+            for scope, count in sorted(self.rejected.items()):
+                lines.append(f"content_server_rejected_streams_total{prometheus_labels(scope=scope)} {count}")
+            lines += [
+                "# HELP content_server_cache_requests_total Cache lookups by cache and result",
+                "# TYPE content_server_cache_requests_total counter",
+            ]
+            for cache, (hits, misses) in sorted(self.caches.items()):
+                lines.append(f"content_server_cache_requests_total{prometheus_labels(cache=cache, result='hit')} {hits}")
+                lines.append(f"content_server_cache_requests_total{prometheus_labels(cache=cache, result='miss')} {misses}")
+            lines += [
+                "# HELP content_server_cache_hit_ratio Share of cache lookups served from memory",
+                "# TYPE content_server_cache_hit_ratio gauge",
+            ]
+            for cache, (hits, misses) in sorted(self.caches.items()):
+                lines.append(f"content_server_cache_hit_ratio{prometheus_labels(cache=cache)} {hits / (hits + misses):.6f}")
+
+            lines += [
+                "# HELP content_server_operation_seconds_total Time spent in expensive operations",
+                "# TYPE content_server_operation_seconds_total counter",
+            ]
+            for name, (_, seconds) in sorted(self.timings.items()):
+                lines.append(f"content_server_operation_seconds_total{prometheus_labels(operation=name)} {seconds}")
+            lines += [
+                "# HELP content_server_operations_total Expensive operations performed",
+                "# TYPE content_server_operations_total counter",
+            ]
+            for name, (count, _) in sorted(self.timings.items()):
+                lines.append(f"content_server_operations_total{prometheus_labels(operation=name)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Bytes/s budget of one stream. rate is a callable, so a shared budget follows the number of
+# running streams; consume() returns how long to pause before sending more
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def consume(self, size):
+        rate = self.rate()
+        now = time.monotonic()
+        # At most one second of unused budget carries over
+        self.tokens = min(rate, self.tokens + (now - self.updated) * rate) - size
+        self.updated = now
+        return -self.tokens / rate if self.tokens < 0 else 0.0
+
+# Concurrent file streams per client address and in total
+class AdmissionControl:
+    def __init__(self, max_streams, max_client_streams):
+        self.max_streams = max_streams
+        self.max_client_streams = max_client_streams
+        self.lock = threading.Lock()
+        self.active = {}
+        self.total = 0
+
+    # None when the stream may start, otherwise the limit that was reached
+    def acquire(self, client):
+        with self.lock:
+            if self.total >= self.max_streams:
+                scope = "global"
+            elif self.active.get(client, 0) >= self.max_client_streams:
+                scope = "client"
+            else:
+                self.active[client] = self.active.get(client, 0) + 1
+                self.total += 1
+                return None
+        metrics.stream_rejected(scope)
+        return scope
+
+    def release(self, client):
+        with self.lock:
+            self.total -= 1
+            if self.active[client] > 1:
+                self.active[client] -= 1
+            else:
+                del self.active[client]
+
+    def stream_rate(self):
+        rates = [STREAM_RATE_LIMIT] if STREAM_RATE_LIMIT else []
+        if TOTAL_RATE_LIMIT:
+            rates.append(TOTAL_RATE_LIMIT / max(1, self.total))
+        return min(rates)
+
+    def new_bucket(self):
+        if not STREAM_RATE_LIMIT and not TOTAL_RATE_LIMIT:
+            return None
+        return TokenBucket(self.stream_rate)
+
+admission = AdmissionControl(MAX_STREAMS, MAX_CLIENT_STREAMS)
+
+def is_stream_request(path):
+    return path.startswith(STREAM_PATHS)
+
+# Address the per-client limit is keyed on; forwarded_for is the X-Forwarded-For value
+def client_address(peer, forwarded_for):
+    if TRUSTED_PROXIES and forwarded_for:
+        addresses = [address.strip() for address in forwarded_for.split(",") if address.strip()]
+        # Each trusted proxy appended the address it received the request from
+        if len(addresses) >= TRUSTED_PROXIES:
+            return addresses[-TRUSTED_PROXIES]
+    return peer
+
+def busy_headers():
+    return {"Retry-After": str(RETRY_AFTER)}
+
+# Opt-in sampling profiler: every interval it records the stack of each other thread, kept as
+# folded stacks ("outer;inner count") ready for flamegraph tools. Costs nothing when not started.
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    stack = ";".join(
+                        f"{os.path.basename(entry.filename)}:{entry.name}" for entry in traceback.extract_stack(frame)
+                    )
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def folded(self, reset=False):
+        with self.lock:
+            stacks = self.stacks
+            if reset:
+                self.stacks = {}
+                self.samples = 0
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+profiler = SamplingProfiler(PROFILE_INTERVAL) if PROFILE_INTERVAL > 0 else None
+
+def start_profiler():
+    if profiler is not None:
+        profiler.start()
+
+# Project id of a request from its URL or JSON body, unknown ids stay out of the metric labels
+def request_project(view_args, data):
+    project = (view_args or {}).get("project")
+    if project is None and isinstance(data, dict):
+        project = data.get("project")
+    return project if isinstance(project, str) and project in PROJECT_DATA else None
+
+# File handed to wsgi.file_wrapper for a zero-copy response. werkzeug returns such a file wrapper
+# to the WSGI server as is, so callbacks given to response.call_on_close never run for it; the
+# server closes the wrapper and with it this file after the last byte, which runs them instead
+class ClosingFile:
+    def __init__(self, file):
+        self.file = file
+        self.callbacks = []
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        self.file.close()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+# Runs callback once the WSGI server is done with the response, however its body was sent
+def call_on_close(response, callback):
+    file = request.environ.get("response.closing_file")
+    if response.direct_passthrough and file is not None:
+        file.callbacks.append(callback)
+    else:
+        response.call_on_close(callback)
+
+@app.before_request
+def start_request_timer():
+    request.environ["metrics.start"] = time.perf_counter()
+
+# Requests are recorded when the WSGI server closes the response, after the last byte of a stream
+@app.after_request
+def record_request_metrics(response):
+    start = request.environ.get("metrics.start", time.perf_counter())
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method = request.method
+    status = response.status_code
+    project = request_project(request.view_args, request.get_json(silent=True) if request.is_json else None)
+    # Content-Length is what was promised; a client dropping a stream early is still counted in full.
+    # HEAD responses promise a length but send no body
+    head = method == "HEAD"
+    sent = 0 if head else response.content_length or 0
+    if response.is_streamed and response.content_length is None and not response.direct_passthrough:
+        counted = [0]
+        body = response.response
+
+        def counting_body():
+            for chunk in body:
+                counted[0] += len(chunk)
+                yield chunk
+
+        response.response = counting_body()
+    else:
+        counted = None
+    streamed = response.is_streamed and status < 400
+    if streamed:
+        metrics.stream_started()
+
+    def finished():
+        if streamed:
+            metrics.stream_finished()
+        metrics.observe_request(
+            route, method, status, time.perf_counter() - start, project, counted[0] if counted else sent
+        )
+
+    call_on_close(response, finished)
+    return response
+
+@app.before_request
+def admit_stream():
+    if not is_stream_request(request.path):
+        return None
+    client = client_address(request.remote_addr, ",".join(request.headers.getlist("X-Forwarded-For")))
+    if admission.acquire(client) is not None:
+        return Response("Server busy, retry later\n", status=503, headers=busy_headers(), content_type="text/plain")
+    request.environ["admission.client"] = client
+    request.environ["admission.bucket"] = admission.new_bucket()
+
+def throttled_body(body, bucket):
+    for chunk in body:
+        yield chunk
+        delay = bucket.consume(len(chunk))
+        if delay:
+            time.sleep(delay)
+
+# The admitted stream is released when the WSGI server closes the response, after its last byte
+@app.after_request
+def release_stream(response):
+    if "admission.client" not in request.environ:
+        return response
+    client = request.environ["admission.client"]
+    bucket = request.environ["admission.bucket"]
+    if bucket is not None and response.is_streamed and not response.direct_passthrough:
+        response.response = throttled_body(response.response, bucket)
+    call_on_close(response, lambda: admission.release(client))
+    return response
+
+@app.route("/metrics")
+def send_metrics():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4")
+
+@app.route("/debug/profile/")
+def send_profile():
+    if profiler is None:
+        abort(404)
+    return Response(profiler.folded(reset=request.args.get("reset") == "1"), content_type="text/plain")
+
+def file_generator(file_path, start=0, length=None, chunk_size=CHUNK_SIZE):
     with open(file_path, 'rb') as file:
-        while chunk := file.read(chunk_size):
+        file.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = file.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
             yield chunk
 
+def file_etag(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+# Resolve Range/If-Range into (status, start, end); only single byte ranges are honoured
+def resolve_range(range_header, if_range_header, size, etag, mtime):
+    if not range_header:
+        return 200, 0, size
+    if if_range_header:
+        if_range = parse_if_range_header(if_range_header)
+        if if_range.etag is not None:
+            if f'"{if_range.etag}"' != etag:
+                return 200, 0, size
+        elif if_range.date is None or int(if_range.date.timestamp()) != int(mtime):
+            return 200, 0, size
+    byte_range = parse_range_header(range_header)
+    if byte_range is None or byte_range.units != "bytes" or len(byte_range.ranges) != 1:
+        return 200, 0, size
+    bounds = byte_range.range_for_length(size)
+    if bounds is None:
+        return 416, 0, 0
+    return 206, bounds[0], bounds[1]
+
+# (path, encoding) of the pre-compressed sidecar to send, (file_path, None) for the file itself.
+# Only whole-file requests are encoded, ranges always address the original bytes.
+def select_encoding(project_dir, filename, accept_encoding, range_header):
+    file_path = os.path.join(project_dir, filename)
+    if range_header or not accept_encoding:
+        return file_path, None
+    accept = parse_accept_header(accept_encoding)
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    for encoding in ("zstd", "gzip"):
+        if accept[encoding] <= 0:
+            continue
+        path = os.path.join(project_dir, COMPRESSED_DIR, filename + ENCODING_SUFFIXES[encoding])
+        try:
+            sidecar = os.stat(path)
+        except FileNotFoundError:
+            continue
+        # Sidecars carry their source's mtime, anything else was compressed from an older version
+        if sidecar.st_mtime_ns == mtime_ns:
+            return path, encoding
+    return file_path, None
+
+# Status, byte bounds and headers for a file download; shared by the Flask and asyncio servers
+def prepare_file_response(file_path, range_header, if_range_header, encoding=None):
+    stat = os.stat(file_path)
+    etag = file_etag(stat)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Vary": "Accept-Encoding",
+    }
+    if encoding is not None:
+        headers["ETag"] = etag = f'{etag[:-1]}-{encoding}"'
+        headers["Content-Encoding"] = encoding
+    status, start, end = resolve_range(range_header, if_range_header, stat.st_size, etag, stat.st_mtime)
+    if status == 416:
+        headers["Content-Range"] = f"bytes */{stat.st_size}"
+        return status, start, end, headers
+    if status == 206:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{stat.st_size}"
+    headers["Content-Length"] = str(end - start)
+    return status, start, end, headers
+
+def stream_file(file_path, encoding=None):
+    status, start, end, headers = prepare_file_response(
+        file_path,
+        request.headers.get("Range"),
+        request.headers.get("If-Range"),
+        encoding,
+    )
+    if status == 416:
+        return Response(status=416, headers=headers)
+
+    # Hand the open file to the WSGI server (sendfile under gunicorn) when it offers a file wrapper;
+    # Content-Length bounds the transfer for ranges. HEAD never iterates the body, so skip the open there
+    # A shaped stream is written in chunks the token bucket can pace
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    shaped = request.environ.get("admission.bucket") is not None
+    if ZERO_COPY and file_wrapper is not None and not shaped and request.method != "HEAD":
+        file = ClosingFile(open(file_path, "rb"))
+        file.seek(start)
+        request.environ["response.closing_file"] = file
+        return Response(
+            file_wrapper(file, CHUNK_SIZE),
+            status=status,
+            headers=headers,
+            content_type='application/octet-stream',
+            direct_passthrough=True,
+        )
+    return Response(
+        file_generator(file_path, start, end - start),
+        status=status,
+        headers=headers,
+        content_type='application/octet-stream',
+    )
+
+# Path of a file a client named inside project_dir, None for absolute names and names that lead
+# out of the directory (through "..", or a symlink)
+def project_file_path(project_dir, filename):
+    if not isinstance(filename, str) or not filename or os.path.isabs(filename):
+        return None
+    root = os.path.realpath(project_dir)
+    path = os.path.realpath(os.path.join(root, filename))
+    if path == root or os.path.commonpath([root, path]) != root:
+        return None
+    return os.path.join(project_dir, filename)
+
 @app.route("/files/", methods=["POST"])
 def send_file():
     data = request.get_json()
@@ -46,50 +578,669 @@ def send_file():
     filename = data.get("filename")
     if project not in PROJECT_DATA.keys():
         abort(404)
-    file_path = os.path.join(FILES_DIR, PROJECT_DATA[project], filename)
-    if os.path.exists(file_path):
-        return Response(file_generator(file_path), content_type='application/octet-stream')
+    project_dir = os.path.join(FILES_DIR, PROJECT_DATA[project])
+    file_path = project_file_path(project_dir, filename)
+    if file_path is not None and os.path.exists(file_path):
+        return stream_file(*select_encoding(
+            project_dir, filename, request.headers.get("Accept-Encoding"), request.headers.get("Range")
+        ))
     else:
         abort(404)
 
+# (path, encoding) to send for a blob, None for names that are not a sha256 hex digest or not
+# published. A file is only served under a checksum while its size and mtime_ns are still the ones
+# its manifest entry was hashed with, so any HTTP cache may keep a blob for good
+def resolve_blob(checksum, accept_encoding, range_header):
+    if not re.fullmatch(r"[0-9a-f]{64}", checksum):
+        return None
+    for project_dir, filename, size, mtime_ns in blob_index.get().get(checksum, ()):
+        try:
+            stat = os.stat(os.path.join(project_dir, filename))
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+            return select_encoding(project_dir, filename, accept_encoding, range_header)
+    return None
+
+@app.route("/blobs/<checksum>")
+def send_blob(checksum):
+    blob = resolve_blob(checksum, request.headers.get("Accept-Encoding"), request.headers.get("Range"))
+    if blob is None:
+        abort(404)
+    response = stream_file(*blob)
+    response.headers["Cache-Control"] = BLOB_CACHE_CONTROL
+    return response
+
+# Built when a manifest changes, typically at a patch launch with every client waiting on it;
+# moderate levels keep that to a fraction of a second for a 100k-entry manifest
+MANIFEST_GZIP_LEVEL = 6
+MANIFEST_ZSTD_LEVEL = 6
+
+class CachedManifest:
+    def __init__(self, key, body, data=None):
+        self.key = key
+        self.data = data
+        digest = hashlib.sha256(body).hexdigest()
+        self.variants = {"identity": (body, f'"{digest}"')}
+        self.variants["gzip"] = (gzip.compress(body, compresslevel=MANIFEST_GZIP_LEVEL), f'"{digest}-gzip"')
+        if zstandard is not None:
+            compressed = zstandard.ZstdCompressor(level=MANIFEST_ZSTD_LEVEL).compress(body)
+            self.variants["zstd"] = (compressed, f'"{digest}-zstd"')
+
+    def negotiate(self, accept_encodings):
+        for encoding in ("zstd", "gzip"):
+            if encoding in self.variants and accept_encodings[encoding] > 0:
+                return encoding
+        return "identity"
+
+# Serialized files_info.json per project, rebuilt only when the file's (inode, size, mtime) changes.
+# Diffs against older revisions are cached per manifest and dropped with it. Every manifest is built
+# under a lock of its own, a project being rebuilt does not hold up requests for the others.
+class ManifestCache:
+    def __init__(self):
+        self.entries = {}
+        self.diffs = {}
+        self.build_locks = {}
+        self.lock = threading.Lock()
+
+    def build_lock(self, info_path):
+        with self.lock:
+            return self.build_locks.setdefault(info_path, threading.Lock())
+
+    def get(self, info_path, project_name):
+        try:
+            stat = os.stat(info_path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        entry = self.entries.get(info_path)
+        if entry is not None and entry.key == key:
+            metrics.cache_access("manifest", True)
+            return entry
+        with self.build_lock(info_path):
+            entry = self.entries.get(info_path)
+            if entry is not None and entry.key == key:
+                metrics.cache_access("manifest", True)
+                return entry
+            metrics.cache_access("manifest", False)
+            start = time.perf_counter()
+            with open(info_path, "r") as f:
+                files_info = json.load(f)
+
+            # Add project name to files_info
+            files_info["project_name"] = project_name
+            # Whole files can be fetched by checksum from /blobs/
+            files_info["blob_store"] = True
+
+            body = json.dumps(files_info, separators=(",", ":")).encode()
+            entry = CachedManifest(key, body, files_info)
+            self.entries[info_path] = entry
+            metrics.observe("manifest_build", time.perf_counter() - start)
+        return entry
+
+    # Changes since revision `since`, or the full manifest when they cannot be told from the history
+    def get_diff(self, info_path, project_name, since):
+        manifest = self.get(info_path, project_name)
+        if manifest is None:
+            return None
+        with self.lock:
+            key, diffs = self.diffs.get(info_path, (None, {}))
+            if key != manifest.key:
+                diffs = {}
+                self.diffs[info_path] = (manifest.key, diffs)
+            if since in diffs:
+                metrics.cache_access("manifest_diff", True)
+                return diffs[since]
+        metrics.cache_access("manifest_diff", False)
+        history = history_cache.get(os.path.join(os.path.dirname(info_path), "manifest_history.json"))
+        diff = build_manifest_diff(manifest.data, history, since)
+        if diff is None:
+            return manifest
+        entry = CachedManifest(manifest.key, json.dumps(diff, separators=(",", ":")).encode())
+        with self.lock:
+            diffs[since] = entry
+        return entry
+
+# manifest_history.json lists the files added, changed and removed by each recent revision.
+# Folds the revisions after `since` into one change set relative to it; None when the
+# history does not reach back that far.
+def compose_changes(history, since):
+    revisions = history["revisions"]
+    if since == history["revision"]:
+        return {}
+    if since > history["revision"] or not revisions or since < revisions[0]["revision"] - 1:
+        return None
+    status = {}
+    for change in revisions:
+        if change["revision"] <= since:
+            continue
+        for file_name in change["added"]:
+            status[file_name] = "changed" if status.get(file_name) == "removed" else "added"
+        for file_name in change["changed"]:
+            if status.get(file_name) != "added":
+                status[file_name] = "changed"
+        for file_name in change["removed"]:
+            if status.pop(file_name, None) != "added":
+                status[file_name] = "removed"
+    return status
+
+def build_manifest_diff(files_info, history, since):
+    # The history must describe exactly the manifest being served
+    if history is None or "revision" not in files_info or history.get("revision") != files_info["revision"]:
+        return None
+    status = compose_changes(history, since)
+    if status is None:
+        return None
+    files = files_info["files"]
+    return {
+        "version": files_info.get("version"),
+        "project_name": files_info.get("project_name"),
+        "revision": files_info["revision"],
+        "blob_store": files_info.get("blob_store", False),
+        "since": since,
+        "added": {name: files[name] for name, change in status.items() if change == "added"},
+        "changed": {name: files[name] for name, change in status.items() if change == "changed"},
+        "removed": sorted(name for name, change in status.items() if change == "removed"),
+    }
+
+manifest_cache = ManifestCache()
+
+# Manifest checksum -> [(project dir, path, size, mtime_ns)] over the manifests of every project,
+# rebuilt when any of them changes. Files are named by the checksum their manifest entry gives,
+# the tree hash root for tree-hashed ones, as clients ask for them
+class BlobIndex:
+    def __init__(self):
+        self.key = None
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def get(self):
+        manifests = []
+        for project_dir in list(PROJECT_DATA.values()):
+            manifest = manifest_cache.get(os.path.join(FILES_DIR, project_dir, "files_info.json"), project_dir)
+            if manifest is not None:
+                manifests.append((project_dir, manifest))
+        key = tuple((project_dir, manifest.key) for project_dir, manifest in manifests)
+        if key == self.key:
+            return self.blobs
+        with self.lock:
+            if key != self.key:
+                start = time.perf_counter()
+                blobs = {}
+                for project_dir, manifest in manifests:
+                    project_path = os.path.join(FILES_DIR, project_dir)
+                    for filename, file_info in manifest.data["files"].items():
+                        if "last_modified_ns" not in file_info:
+                            continue
+                        blobs.setdefault(file_info["checksum"], []).append(
+                            (project_path, filename, file_info["size"], file_info["last_modified_ns"])
+                        )
+                self.blobs, self.key = blobs, key
+                metrics.observe("blob_index_build", time.perf_counter() - start)
+        return self.blobs
+
+blob_index = BlobIndex()
+
+def prepare_manifest_response(manifest, accept_encoding, if_none_match):
+    encoding = manifest.negotiate(parse_accept_header(accept_encoding))
+    body, etag = manifest.variants[encoding]
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+        "Content-Type": "application/json",
+    }
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    if parse_etags(if_none_match).contains_weak(etag.strip('"')):
+        return 304, b"", headers
+    return 200, body, headers
+
+def manifest_response(manifest):
+    status, body, headers = prepare_manifest_response(
+        manifest,
+        request.headers.get("Accept-Encoding"),
+        request.headers.get("If-None-Match"),
+    )
+    return Response(body, status=status, headers=headers)
+
+# Write end of a streamed tar archive; tarfile writes records here and the generator drains them
+class BundleBuffer:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def resolve_bundle(project, filenames):
+    if project not in PROJECT_DATA.keys():
+        raise LookupError(project)
+    if not isinstance(filenames, list) or not 0 < len(filenames) <= BUNDLE_MAX_FILES:
+        raise ValueError("Invalid bundle file list")
+    project_dir = os.path.join(FILES_DIR, PROJECT_DATA[project])
+    for filename in filenames:
+        file_path = project_file_path(project_dir, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            raise LookupError(filename)
+        # Members are buffered whole while tarfile copies them, so only small files are allowed
+        if os.path.getsize(file_path) > BUNDLE_MAX_FILE_SIZE:
+            raise ValueError(f"{filename} is too large to bundle")
+    return project_dir
+
+# Members for which the client accepts a pre-compressed sidecar carry the sidecar's bytes and
+# name the encoding in their "encoding" PAX header
+def bundle_generator(project_dir, filenames, accept_encoding=None):
+    buffer = BundleBuffer()
+    with tarfile.open(fileobj=buffer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for filename in filenames:
+            file_path, encoding = select_encoding(project_dir, filename, accept_encoding, None)
+            with open(file_path, "rb") as f:
+                info = tar.gettarinfo(arcname=filename, fileobj=f)
+                info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                if encoding is not None:
+                    info.pax_headers = {"encoding": encoding}
+                tar.addfile(info, f)
+            if data := buffer.drain():
+                yield data
+    yield buffer.drain()
+
+@app.route("/bundle/", methods=["POST"])
+def send_bundle():
+    data = request.get_json()
+    filenames = data.get("filenames")
+    try:
+        project_dir = resolve_bundle(data.get("project"), filenames)
+    except LookupError:
+        abort(404)
+    except ValueError:
+        abort(400)
+    return Response(
+        bundle_generator(project_dir, filenames, request.headers.get("Accept-Encoding")),
+        content_type='application/x-tar',
+    )
+
 @app.route("/files_info/<project>/")
 def send_files_info(project):
     if project not in PROJECT_DATA.keys():
         abort(404)
+    if "page" in request.args:
+        page = request.args.get("page", type=int)
+        if page is None:
+            abort(400)
+        return send_manifest_page(project, page)
     info_path = os.path.join(FILES_DIR, PROJECT_DATA[project], "files_info.json")
-    if os.path.exists(info_path):
-        with open(info_path, "r") as f:
-            files_info = json.load(f)
+    manifest = manifest_cache.get(info_path, PROJECT_DATA[project])
+    if manifest is None:
+        abort(404)
+    return manifest_response(manifest)
 
-        # Add project name to files_info
-        files_info["project_name"] = PROJECT_DATA[project]
+@app.route("/files_info/<project>/since/<int:revision>/")
+def send_files_info_diff(project, revision):
+    if project not in PROJECT_DATA.keys():
+        abort(404)
+    info_path = os.path.join(FILES_DIR, PROJECT_DATA[project], "files_info.json")
+    manifest = manifest_cache.get_diff(info_path, PROJECT_DATA[project], revision)
+    if manifest is None:
+        abort(404)
+    return manifest_response(manifest)
 
-        return jsonify(files_info)
-    else:
+# Parsed JSON sidecars such as block_signatures.json, reloaded when the file's stat changes
+class JsonFileCache:
+    def __init__(self, name):
+        self.name = name
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == key:
+            metrics.cache_access(self.name, True)
+            return entry[1]
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != key:
+                metrics.cache_access(self.name, False)
+                start = time.perf_counter()
+                with open(path, "r") as f:
+                    entry = (key, json.load(f))
+                self.entries[path] = entry
+                metrics.observe(f"{self.name}_load", time.perf_counter() - start)
+            else:
+                metrics.cache_access(self.name, True)
+        return entry[1]
+
+signature_cache = JsonFileCache("block_signatures")
+history_cache = JsonFileCache("manifest_history")
+manifest_index_cache = JsonFileCache("manifest_index")
+
+# One page of a project's manifest as NDJSON: a header line, then its ["path", {entry}] lines.
+# Returns (header, page path, encoding) or None when the project has no current paged manifest;
+# a gzip client gets the pre-compressed page behind a gzip member of its own for the header.
+# The page path is None for the single empty page of a project without files
+def resolve_manifest_page(project, page, accept_encoding):
+    project_dir = os.path.join(FILES_DIR, PROJECT_DATA[project])
+    index = manifest_index_cache.get(os.path.join(project_dir, MANIFEST_DIR, "index.json"))
+    if index is None:
+        return None
+    try:
+        stat = os.stat(os.path.join(project_dir, "files_info.json"))
+    except FileNotFoundError:
+        return None
+    # The index was made from another files_info.json, e.g. before the Rust generator ran
+    if index.get("source") != [stat.st_size, stat.st_mtime_ns]:
+        return None
+    pages = index["pages"]
+    if not (0 <= page < len(pages) or page == 0):
+        return None
+    header = (json.dumps({
+        "version": index["version"],
+        "project_name": PROJECT_DATA[project],
+        "revision": index["revision"],
+        "blob_store": True,
+        "generation": index["generation"],
+        "page": page,
+        "pages": len(pages),
+        "files": index["files"],
+    }, separators=(",", ":")) + "\n").encode()
+    if not pages:
+        return header, None, None
+    page_path = os.path.join(project_dir, MANIFEST_DIR, f"{index['generation']}-{page}.ndjson")
+    if accept_encoding and parse_accept_header(accept_encoding)["gzip"] > 0 and os.path.exists(f"{page_path}.gz"):
+        return gzip.compress(header), f"{page_path}.gz", "gzip"
+    if not os.path.exists(page_path):
+        return None
+    return header, page_path, None
+
+def manifest_page_headers(header, page_path, encoding):
+    headers = {
+        "Content-Length": str(len(header) + (os.path.getsize(page_path) if page_path else 0)),
+        "Vary": "Accept-Encoding",
+    }
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return headers
+
+def manifest_page_generator(header, page_path):
+    yield header
+    if page_path is not None:
+        yield from file_generator(page_path)
+
+def send_manifest_page(project, page):
+    resolved = resolve_manifest_page(project, page, request.headers.get("Accept-Encoding"))
+    if resolved is None:
+        abort(404)
+    return Response(
+        manifest_page_generator(resolved[0], resolved[1]),
+        headers=manifest_page_headers(*resolved),
+        content_type="application/x-ndjson",
+    )
+
+def find_block_signature(project, filename):
+    if project not in PROJECT_DATA.keys():
+        return None
+    signatures = signature_cache.get(os.path.join(FILES_DIR, PROJECT_DATA[project], "block_signatures.json"))
+    if signatures is None:
+        return None
+    return signatures["files"].get(filename)
+
+# Byte ranges of the requested blocks, in request order
+def resolve_blocks(file_path, block_size, blocks):
+    size = os.path.getsize(file_path)
+    block_count = (size + block_size - 1) // block_size
+    ranges = []
+    for index in blocks:
+        if not isinstance(index, int) or not 0 <= index < block_count:
+            raise ValueError(f"Invalid block index {index!r}")
+        start = index * block_size
+        ranges.append((start, min(block_size, size - start)))
+    return ranges
+
+def ranges_generator(file_path, ranges, chunk_size=CHUNK_SIZE):
+    with open(file_path, 'rb') as file:
+        for start, length in ranges:
+            file.seek(start)
+            while length > 0:
+                chunk = file.read(min(chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+@app.route("/block_signatures/", methods=["POST"])
+def send_block_signatures():
+    data = request.get_json()
+    signature = find_block_signature(data.get("project"), data.get("filename"))
+    if signature is None:
         abort(404)
+    return jsonify(signature)
+
+@app.route("/blocks/", methods=["POST"])
+def send_blocks():
+    data = request.get_json()
+    project = data.get("project")
+    filename = data.get("filename")
+    signature = find_block_signature(project, filename)
+    if signature is None:
+        abort(404)
+    file_path = os.path.join(FILES_DIR, PROJECT_DATA[project], filename)
+    if not os.path.exists(file_path):
+        abort(404)
+    try:
+        ranges = resolve_blocks(file_path, signature["block_size"], data.get("blocks") or [])
+    except ValueError:
+        abort(400)
+    return Response(
+        ranges_generator(file_path, ranges),
+        headers={"Content-Length": str(sum(length for _, length in ranges))},
+        content_type='application/octet-stream',
+    )
 
 @app.route("/status/")
 def status():
     return jsonify({"status": "ok"})
 
+# Update manifest for deploy/game_updater.exe, rehashed only when the file's stat changes
+# or, while a watcher is running, when the watcher reports a change
+class UpdateInfoCache:
+    def __init__(self, path):
+        self.path = path
+        self.patches_dir = os.path.join(os.path.dirname(path), "patches")
+        self.entry = None
+        self.watching = False
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        # Waits for a build in progress, which may have read the file before the change
+        with self.lock:
+            self.entry = None
+
+    def is_current(self, entry, key):
+        return entry is not None and (self.watching or entry.key == key)
+
+    def get(self):
+        entry = self.entry
+        if entry is not None and self.watching:
+            metrics.cache_access("update_info", True)
+            return entry
+        stat = os.stat(self.path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if self.is_current(entry, key):
+            metrics.cache_access("update_info", True)
+            return entry
+        # Concurrent requests for a new executable wait for one hash instead of each hashing it
+        with self.lock:
+            entry = self.entry
+            if self.is_current(entry, key):
+                metrics.cache_access("update_info", True)
+                return entry
+            metrics.cache_access("update_info", False)
+            start = time.perf_counter()
+            update_info = self.build(stat)
+            entry = CachedManifest(key, json.dumps(update_info, separators=(",", ":")).encode(), update_info)
+            self.entry = entry
+            metrics.observe("update_info_hash", time.perf_counter() - start)
+        return entry
+
+    def build(self, stat):
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+                sha256.update(chunk)
+        update_info = {
+            "version": md5.hexdigest(),
+            "files": {
+                os.path.basename(self.path): {
+                    "checksum": sha256.hexdigest(),
+                    "md5": md5.hexdigest(),
+                    "size": stat.st_size,
+                    "last_modified": stat.st_mtime,
+                },
+            },
+            "patches": self.list_patches(md5.hexdigest()),
+        }
+        return update_info
+
+    def list_patches(self, version):
+        # tools/publish_update.py writes the patches to a version before the executable itself
+        patches = {}
+        suffix = f"-{version}.patch"
+        try:
+            names = os.listdir(self.patches_dir)
+        except FileNotFoundError:
+            return patches
+        for name in names:
+            if name.endswith(suffix):
+                patches[name[:-len(suffix)]] = {"size": os.path.getsize(os.path.join(self.patches_dir, name))}
+        return patches
+
+    # Patch from the `version` to the current executable, or None when none is published
+    def patch_path(self, version):
+        update_info = self.get().data
+        if version not in update_info["patches"]:
+            return None
+        return os.path.join(self.patches_dir, f"{version}-{update_info['version']}.patch")
+
+class UpdateWatchHandler:
+    def __init__(self, cache):
+        self.cache = cache
+
+    def dispatch(self, event):
+        # Reading the file ourselves raises opened/closed_no_write events, ignore those
+        if event.event_type not in ("created", "modified", "moved", "deleted", "closed"):
+            return
+        paths = (getattr(event, "src_path", ""), getattr(event, "dest_path", ""))
+        if any(os.path.basename(path) == os.path.basename(self.cache.path) for path in paths):
+            self.cache.invalidate()
+
+update_info_cache = UpdateInfoCache(os.path.join(FILES_DIR, 'deploy', 'game_updater.exe'))
+
+def start_update_watcher():
+    if Observer is None or not os.path.isdir(os.path.dirname(update_info_cache.path)):
+        return None
+    observer = Observer()
+    observer.schedule(UpdateWatchHandler(update_info_cache), os.path.dirname(update_info_cache.path))
+    observer.daemon = True
+    observer.start()
+    update_info_cache.invalidate()
+    update_info_cache.watching = True
+    return observer
+
 @app.route("/update_info/")
 def update_info():
-    checksum = hashlib.md5()
-    with open(f"{FILES_DIR}/deploy/game_updater.exe", "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            checksum.update(chunk)
-    checksum = checksum.hexdigest()
-    return jsonify({"version": checksum})
+    try:
+        manifest = update_info_cache.get()
+    except FileNotFoundError:
+        abort(404)
+    return manifest_response(manifest)
 
 @app.route("/download_update/")
 def download_update():
     file_path = os.path.join(FILES_DIR, 'deploy', 'game_updater.exe')
     if os.path.exists(file_path):
-        return Response(file_generator(file_path), content_type='application/octet-stream')
+        return stream_file(file_path)
     else:
         abort(404)
 
+@app.route("/download_update/patch/<version>/")
+def download_update_patch(version):
+    try:
+        file_path = update_info_cache.patch_path(version)
+    except FileNotFoundError:
+        abort(404)
+    if file_path is None or not os.path.exists(file_path):
+        abort(404)
+    return stream_file(file_path)
+
+# Hot reload of the project map. PROJECT_DATA is updated in place, so modules that imported it
+# see the change, and requests already streaming a file are not affected.
+class ProjectDataReloader:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.key = self.stat_key()
+
+    def stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def reload(self, force=False):
+        with self.lock:
+            key = self.stat_key()
+            if key is None or (key == self.key and not force):
+                return False
+            try:
+                with open(self.path, "r") as f:
+                    project_data = json.load(f)
+            except (OSError, ValueError) as e:
+                # Most likely caught mid-write, the next check picks up the finished file
+                app.logger.warning(f"Keeping the current project map, {self.path} could not be read: {e}")
+                return False
+            self.key = key
+            PROJECT_DATA.update(project_data)
+            for project in [project for project in PROJECT_DATA if project not in project_data]:
+                del PROJECT_DATA[project]
+        app.logger.info(f"Reloaded project map with {len(project_data)} projects")
+        return True
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            self.reload()
+
+project_data_reloader = ProjectDataReloader(os.getenv("PROJECT_DATA"))
+
+def reload_project_data():
+    return project_data_reloader.reload(force=True)
+
+def start_project_data_watcher(interval=PROJECT_DATA_POLL_INTERVAL):
+    thread = threading.Thread(target=project_data_reloader.watch, args=(interval,), daemon=True)
+    thread.start()
+    return thread
+
 if __name__ == "__main__":
+    start_update_watcher()
+    start_profiler()
+    start_project_data_watcher()
+    # SIGHUP reloads the project map right away
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_project_data())
     app.run(
         host="0.0.0.0",
         port=PORT,
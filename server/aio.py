@@ -0,0 +1,408 @@
+import os
+import ssl
+import json
+import time
+import signal
+import asyncio
+import logging
+
+from aiohttp import web
+
+from server import (
+    FILES_DIR,
+    PROJECT_DATA,
+    PORT,
+    ZERO_COPY,
+    CHUNK_SIZE,
+    csp_policy,
+    generate_csp_header,
+    manifest_cache,
+    update_info_cache,
+    prepare_file_response,
+    select_encoding,
+    project_file_path,
+    resolve_blob,
+    resolve_manifest_page,
+    manifest_page_headers,
+    BLOB_CACHE_CONTROL,
+    prepare_manifest_response,
+    start_update_watcher,
+    find_block_signature,
+    resolve_blocks,
+    resolve_bundle,
+    bundle_generator,
+    metrics,
+    profiler,
+    start_profiler,
+    request_project,
+    reload_project_data,
+    start_project_data_watcher,
+    admission,
+    is_stream_request,
+    busy_headers,
+    client_address,
+)
+
+logger = logging.getLogger(__name__)
+
+# Asyncio entry point exposing the same routes as the Flask app: python -m server.aio
+# Every download is a coroutine instead of a thread, writes wait on the transport's
+# drain (backpressure) and SIGTERM/SIGINT stop accepting and let running transfers finish.
+
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT") or 0) or 300.0
+
+class Transfers:
+    def __init__(self):
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def __enter__(self):
+        self.active += 1
+        self.idle.clear()
+        metrics.stream_started()
+        return self
+
+    def __exit__(self, *exc):
+        self.active -= 1
+        if self.active == 0:
+            self.idle.set()
+        metrics.stream_finished()
+
+# Handlers stream inside the coroutine, so the recorded duration runs to the last byte
+@web.middleware
+async def record_request_metrics(request, handler):
+    start = time.perf_counter()
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        sent = 0
+        # HEAD responses promise a length but send no body
+        if response is not None and request.method != "HEAD":
+            # loop.sendfile bypasses the payload writer, rely on the promised length there
+            sent = response.content_length or getattr(response, "body_length", 0) or 0
+        project = request_project(request.match_info, request.get("json"))
+        metrics.observe_request(route, request.method, status, time.perf_counter() - start, project, sent)
+
+# File streams over the admission limits are refused before any work is done for them
+@web.middleware
+async def admission_control(request, handler):
+    if not is_stream_request(request.path):
+        return await handler(request)
+    client = client_address(request.remote, ",".join(request.headers.getall("X-Forwarded-For", [])))
+    if admission.acquire(client) is not None:
+        raise web.HTTPServiceUnavailable(headers=busy_headers(), text="Server busy, retry later\n")
+    request["bucket"] = admission.new_bucket()
+    try:
+        return await handler(request)
+    finally:
+        admission.release(client)
+
+async def throttle(bucket, size):
+    if bucket is not None:
+        delay = bucket.consume(size)
+        if delay:
+            await asyncio.sleep(delay)
+
+async def add_security_headers(request, response):
+    response.headers["Content-Security-Policy"] = generate_csp_header(csp_policy)
+
+async def send_chunks(response, file_path, start, count, bucket=None):
+    loop = asyncio.get_running_loop()
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        while count > 0:
+            chunk = await loop.run_in_executor(None, file.read, min(CHUNK_SIZE, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            await response.write(chunk)
+            await throttle(bucket, len(chunk))
+
+async def stream_file(request, file_path, encoding=None, extra_headers=None):
+    status, start, end, headers = prepare_file_response(
+        file_path,
+        request.headers.get("Range"),
+        request.headers.get("If-Range"),
+        encoding,
+    )
+    headers.update(extra_headers or {})
+    if status == 416:
+        return web.Response(status=416, headers=headers)
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = "application/octet-stream"
+    with request.app["transfers"]:
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        transport = request.transport
+        if transport is None:
+            raise ConnectionResetError("Connection lost")
+        # A shaped stream is written in chunks the token bucket can pace
+        if ZERO_COPY and request.get("bucket") is None:
+            # loop.sendfile falls back to buffered reads by itself on TLS transports
+            with open(file_path, "rb") as file:
+                await asyncio.get_running_loop().sendfile(transport, file, start, end - start)
+        else:
+            await send_chunks(response, file_path, start, end - start, request.get("bucket"))
+        await response.write_eof()
+    return response
+
+async def manifest_response(request, manifest):
+    status, body, headers = prepare_manifest_response(
+        manifest,
+        request.headers.get("Accept-Encoding"),
+        request.headers.get("If-None-Match"),
+    )
+    return web.Response(body=body or None, status=status, headers=headers)
+
+async def read_json(request):
+    try:
+        request["json"] = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest()
+    return request["json"]
+
+async def send_file(request):
+    data = await read_json(request)
+    project = data.get("project")
+    filename = data.get("filename")
+    if project not in PROJECT_DATA.keys():
+        raise web.HTTPNotFound()
+    project_dir = os.path.join(FILES_DIR, PROJECT_DATA[project])
+    file_path = project_file_path(project_dir, filename)
+    if file_path is None or not os.path.exists(file_path):
+        raise web.HTTPNotFound()
+    file_path, encoding = select_encoding(
+        project_dir, filename, request.headers.get("Accept-Encoding"), request.headers.get("Range")
+    )
+    return await stream_file(request, file_path, encoding)
+
+async def send_blob(request):
+    # Rebuilds the blob index when a manifest changed, keep that off the event loop
+    blob = await asyncio.get_running_loop().run_in_executor(
+        None, resolve_blob,
+        request.match_info["checksum"], request.headers.get("Accept-Encoding"), request.headers.get("Range"),
+    )
+    if blob is None:
+        raise web.HTTPNotFound()
+    return await stream_file(request, *blob, extra_headers={"Cache-Control": BLOB_CACHE_CONTROL})
+
+async def send_bundle(request):
+    data = await read_json(request)
+    filenames = data.get("filenames")
+    loop = asyncio.get_running_loop()
+    try:
+        project_dir = await loop.run_in_executor(None, resolve_bundle, data.get("project"), filenames)
+    except LookupError:
+        raise web.HTTPNotFound()
+    except ValueError:
+        raise web.HTTPBadRequest()
+    response = web.StreamResponse()
+    response.content_type = "application/x-tar"
+    with request.app["transfers"]:
+        await response.prepare(request)
+        # Each step reads one member from disk, run it off the event loop
+        archive = bundle_generator(project_dir, filenames, request.headers.get("Accept-Encoding"))
+        while (chunk := await loop.run_in_executor(None, next, archive, None)) is not None:
+            await response.write(chunk)
+            await throttle(request.get("bucket"), len(chunk))
+        await response.write_eof()
+    return response
+
+async def send_manifest_page(request, project, page):
+    resolved = resolve_manifest_page(project, page, request.headers.get("Accept-Encoding"))
+    if resolved is None:
+        raise web.HTTPNotFound()
+    header, page_path, encoding = resolved
+    response = web.StreamResponse(headers=manifest_page_headers(header, page_path, encoding))
+    response.content_type = "application/x-ndjson"
+    with request.app["transfers"]:
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        await response.write(header)
+        if page_path is not None:
+            await send_chunks(response, page_path, 0, os.path.getsize(page_path))
+        await response.write_eof()
+    return response
+
+async def send_files_info(request):
+    project = request.match_info["project"]
+    if project not in PROJECT_DATA.keys():
+        raise web.HTTPNotFound()
+    if "page" in request.query:
+        try:
+            page = int(request.query["page"])
+        except ValueError:
+            raise web.HTTPBadRequest()
+        return await send_manifest_page(request, project, page)
+    info_path = os.path.join(FILES_DIR, PROJECT_DATA[project], "files_info.json")
+    # Cache misses parse JSON and compress, keep that off the event loop
+    manifest = await asyncio.get_running_loop().run_in_executor(
+        None, manifest_cache.get, info_path, PROJECT_DATA[project]
+    )
+    if manifest is None:
+        raise web.HTTPNotFound()
+    return await manifest_response(request, manifest)
+
+async def send_files_info_diff(request):
+    project = request.match_info["project"]
+    if project not in PROJECT_DATA.keys():
+        raise web.HTTPNotFound()
+    info_path = os.path.join(FILES_DIR, PROJECT_DATA[project], "files_info.json")
+    manifest = await asyncio.get_running_loop().run_in_executor(
+        None, manifest_cache.get_diff, info_path, PROJECT_DATA[project], int(request.match_info["revision"])
+    )
+    if manifest is None:
+        raise web.HTTPNotFound()
+    return await manifest_response(request, manifest)
+
+async def send_block_signatures(request):
+    data = await read_json(request)
+    signature = await asyncio.get_running_loop().run_in_executor(
+        None, find_block_signature, data.get("project"), data.get("filename")
+    )
+    if signature is None:
+        raise web.HTTPNotFound()
+    return web.json_response(signature)
+
+async def send_blocks(request):
+    data = await read_json(request)
+    project = data.get("project")
+    filename = data.get("filename")
+    signature = await asyncio.get_running_loop().run_in_executor(
+        None, find_block_signature, project, filename
+    )
+    if signature is None:
+        raise web.HTTPNotFound()
+    file_path = os.path.join(FILES_DIR, PROJECT_DATA[project], filename)
+    if not os.path.exists(file_path):
+        raise web.HTTPNotFound()
+    try:
+        ranges = resolve_blocks(file_path, signature["block_size"], data.get("blocks") or [])
+    except ValueError:
+        raise web.HTTPBadRequest()
+    response = web.StreamResponse(headers={"Content-Length": str(sum(length for _, length in ranges))})
+    response.content_type = "application/octet-stream"
+    with request.app["transfers"]:
+        await response.prepare(request)
+        for start, length in ranges:
+            await send_chunks(response, file_path, start, length, request.get("bucket"))
+        await response.write_eof()
+    return response
+
+async def status(request):
+    return web.json_response({"status": "ok"})
+
+async def send_metrics(request):
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+async def send_profile(request):
+    if profiler is None:
+        raise web.HTTPNotFound()
+    return web.Response(text=profiler.folded(reset=request.query.get("reset") == "1"), content_type="text/plain")
+
+async def update_info(request):
+    try:
+        manifest = await asyncio.get_running_loop().run_in_executor(None, update_info_cache.get)
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    return await manifest_response(request, manifest)
+
+async def download_update(request):
+    file_path = os.path.join(FILES_DIR, 'deploy', 'game_updater.exe')
+    if not os.path.exists(file_path):
+        raise web.HTTPNotFound()
+    return await stream_file(request, file_path)
+
+async def download_update_patch(request):
+    try:
+        file_path = await asyncio.get_running_loop().run_in_executor(
+            None, update_info_cache.patch_path, request.match_info["version"]
+        )
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    if file_path is None or not os.path.exists(file_path):
+        raise web.HTTPNotFound()
+    return await stream_file(request, file_path)
+
+def create_app():
+    app = web.Application(middlewares=[record_request_metrics, admission_control])
+    app["transfers"] = Transfers()
+    app.on_response_prepare.append(add_security_headers)
+    app.router.add_post("/files/", send_file)
+    app.router.add_post("/bundle/", send_bundle)
+    app.router.add_get("/blobs/{checksum}", send_blob)
+    app.router.add_get("/files_info/{project}/", send_files_info)
+    app.router.add_get(r"/files_info/{project}/since/{revision:\d+}/", send_files_info_diff)
+    app.router.add_post("/block_signatures/", send_block_signatures)
+    app.router.add_post("/blocks/", send_blocks)
+    app.router.add_get("/status/", status)
+    app.router.add_get("/metrics", send_metrics)
+    app.router.add_get("/debug/profile/", send_profile)
+    app.router.add_get("/update_info/", update_info)
+    app.router.add_get("/download_update/", download_update)
+    app.router.add_get("/download_update/patch/{version}/", download_update_patch)
+    return app
+
+def create_ssl_context():
+    if not os.getenv("SSL_CERT"):
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(os.getenv("SSL_CERT"), os.getenv("SSL_KEY"))
+    return context
+
+# sock serves on an already listening socket (inherited from a pre-fork master), reuse_port
+# lets several processes bind the same port with SO_REUSEPORT
+async def serve(host="0.0.0.0", port=PORT, sock=None, reuse_port=False):
+    app = create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    if sock is not None:
+        site = web.SockSite(runner, sock, ssl_context=create_ssl_context(), backlog=4096)
+    else:
+        site = web.TCPSite(
+            runner, host, port, ssl_context=create_ssl_context(), backlog=4096, reuse_port=reuse_port or None
+        )
+    await site.start()
+    logger.info(f"Serving on {host}:{port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    # SIGHUP reloads the project map without touching running transfers
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, reload_project_data)
+    await stop.wait()
+
+    # Stop accepting new connections, then give in-flight downloads time to drain
+    transfers = app["transfers"]
+    logger.info(f"Shutting down, waiting for {transfers.active} transfers")
+    await site.stop()
+    try:
+        await asyncio.wait_for(transfers.idle.wait(), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Shutdown timeout reached with {transfers.active} transfers still running")
+    await runner.cleanup()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    start_update_watcher()
+    start_profiler()
+    start_project_data_watcher()
+    asyncio.run(serve())
@@ -0,0 +1,115 @@
+import os
+import gc
+import time
+import signal
+import socket
+import asyncio
+import logging
+
+from server import (
+    FILES_DIR,
+    PROJECT_DATA,
+    PORT,
+    blob_index,
+    manifest_cache,
+    start_update_watcher,
+    start_profiler,
+    start_project_data_watcher,
+)
+from server.aio import serve
+
+logger = logging.getLogger(__name__)
+
+# Pre-fork entry point running WORKERS copies of the asyncio server: python -m server.prefork
+# The master loads the project map and builds every project's manifest before forking, so the
+# workers start with those caches shared copy-on-write and only rebuild what changes later.
+# With SO_REUSEPORT every worker binds the port itself and the kernel spreads connections
+# across them, elsewhere all workers accept on one socket inherited from the master.
+# SIGHUP reloads the project map in every worker, SIGTERM/SIGINT let the workers drain their
+# transfers and stop, and a worker that dies on its own is replaced.
+
+WORKERS = int(os.getenv("WORKERS") or 0) or os.cpu_count() or 1
+REUSE_PORT = hasattr(socket, "SO_REUSEPORT") and (os.getenv("REUSE_PORT") or "1") != "0"
+RESPAWN_DELAY = 1.0  # in seconds, keeps a worker that crashes on start from spinning
+
+def warm_caches():
+    for project_dir in PROJECT_DATA.values():
+        manifest_cache.get(os.path.join(FILES_DIR, project_dir, "files_info.json"), project_dir)
+    blob_index.get()
+
+def listen_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(4096)
+    return sock
+
+def run_worker(host, port, sock):
+    # The asyncio server installs its own handlers; threads do not survive fork, start them here
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    start_update_watcher()
+    start_project_data_watcher()
+    start_profiler()
+    asyncio.run(serve(host, port, sock=sock, reuse_port=REUSE_PORT))
+
+def spawn(host, port, sock):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_worker(host, port, sock)
+        except BaseException:
+            logger.exception("Worker failed")
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+def main(host="0.0.0.0", port=PORT, workers=WORKERS):
+    if not hasattr(os, "fork"):
+        raise SystemExit("The pre-fork server needs os.fork, run python -m server.aio instead")
+    warm_caches()
+    sock = None if REUSE_PORT else listen_socket(host, port)
+    # Keep the warmed objects out of the collector, its refcount writes would copy every page
+    gc.freeze()
+
+    children = {spawn(host, port, sock) for _ in range(workers)}
+    logger.info(f"Started {len(children)} workers on {host}:{port} (SO_REUSEPORT: {REUSE_PORT})")
+    stopping = False
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        forward(signum, frame)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, forward)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, starting a new one")
+            time.sleep(RESPAWN_DELAY)
+            children.add(spawn(host, port, sock))
+    logger.info("All workers stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s][%(levelname)s][%(process)d][%(name)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
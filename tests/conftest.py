@@ -0,0 +1,31 @@
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Client modules and tools import their siblings as top-level modules
+sys.path[:0] = [ROOT, os.path.join(ROOT, "client"), os.path.join(ROOT, "tools")]
+
+# The server reads its configuration on import: one project, "test", holding data.bin
+FILES_DIR = tempfile.mkdtemp()
+PROJECT_DIR = os.path.join(FILES_DIR, "Test Project")
+os.makedirs(PROJECT_DIR)
+with open(os.path.join(PROJECT_DIR, "data.bin"), "wb") as f:
+    f.write(os.urandom(64 * 1024))
+with open(os.path.join(PROJECT_DIR, "data.bin"), "rb") as f:
+    CHECKSUM = hashlib.sha256(f.read()).hexdigest()
+STAT = os.stat(os.path.join(PROJECT_DIR, "data.bin"))
+with open(os.path.join(PROJECT_DIR, "files_info.json"), "w") as f:
+    json.dump({"version": "Test Project", "revision": 1, "files": {
+        "data.bin": {"checksum": CHECKSUM, "size": STAT.st_size, "last_modified_ns": STAT.st_mtime_ns},
+    }}, f)
+with open(os.path.join(FILES_DIR, "project_data.json"), "w") as f:
+    json.dump({"test": "Test Project"}, f)
+os.environ["FILES_DIR"] = FILES_DIR
+os.environ["PROJECT_DATA"] = os.path.join(FILES_DIR, "project_data.json")
+os.environ.setdefault("PORT", "5000")
+# The manifest generator insists on its paths being set
+os.environ["BASE_PATH"] = FILES_DIR
+os.environ["PROJECT_DATA_PATH"] = os.path.join(FILES_DIR, "project_data.json")
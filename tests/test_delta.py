@@ -0,0 +1,63 @@
+import io
+import os
+import zlib
+import hashlib
+
+import pytest
+
+from delta import build_file, missing_blocks, plan_blocks
+
+BLOCK_SIZE = 1024
+
+def signature_of(data):
+    blocks = [data[offset:offset + BLOCK_SIZE] for offset in range(0, len(data), BLOCK_SIZE)]
+    return {
+        "block_size": BLOCK_SIZE,
+        "size": len(data),
+        "checksum": hashlib.sha256(data).hexdigest(),
+        "weak": [zlib.adler32(block) for block in blocks],
+        "strong": [hashlib.sha256(block).hexdigest() for block in blocks],
+    }
+
+def blocks_of(data, indexes):
+    return b"".join(data[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE] for index in indexes)
+
+@pytest.fixture
+def files(tmp_path):
+    old = os.urandom(4 * BLOCK_SIZE)
+    # Block 0 moved to the end, block 1 changed, and a short new last block
+    new = old[BLOCK_SIZE * 2:BLOCK_SIZE * 4] + os.urandom(BLOCK_SIZE) + old[:BLOCK_SIZE] + os.urandom(100)
+    local_path = tmp_path / "old.bin"
+    local_path.write_bytes(old)
+    return str(local_path), str(tmp_path / "new.bin"), new
+
+def test_only_blocks_missing_locally_are_fetched(files):
+    local_path, _, new = files
+    plan = plan_blocks(local_path, signature_of(new))
+    assert missing_blocks(plan) == [2, 4]
+    assert plan[3] == (0, BLOCK_SIZE)
+
+def test_patched_file_matches_the_new_file(files):
+    local_path, target_path, new = files
+    signature = signature_of(new)
+    plan = plan_blocks(local_path, signature)
+    build_file(local_path, target_path, signature, plan, io.BytesIO(blocks_of(new, missing_blocks(plan))))
+    with open(target_path, "rb") as f:
+        assert f.read() == new
+
+def test_patch_with_wrong_blocks_is_discarded(files):
+    local_path, target_path, new = files
+    signature = signature_of(new)
+    plan = plan_blocks(local_path, signature)
+    blocks = bytearray(blocks_of(new, missing_blocks(plan)))
+    blocks[0] ^= 1
+    with pytest.raises(IOError):
+        build_file(local_path, target_path, signature, plan, io.BytesIO(bytes(blocks)))
+    assert not os.path.exists(target_path)
+
+def test_truncated_block_stream_fails(files):
+    local_path, target_path, new = files
+    signature = signature_of(new)
+    plan = plan_blocks(local_path, signature)
+    with pytest.raises(IOError):
+        build_file(local_path, target_path, signature, plan, io.BytesIO(blocks_of(new, missing_blocks(plan))[:-1]))
@@ -0,0 +1,54 @@
+import copy
+
+import server
+from sync import apply_manifest_diff
+
+def entry(checksum):
+    return {"checksum": checksum, "size": 1}
+
+def manifest(revision, files):
+    return {"version": "1.0", "project_name": "Test Project", "revision": revision, "files": files}
+
+REVISIONS = [
+    {"revision": 1, "added": ["a", "b"], "changed": [], "removed": []},
+    {"revision": 2, "added": ["c"], "changed": ["a"], "removed": ["b"]},
+    {"revision": 3, "added": ["b"], "changed": [], "removed": ["c"]},
+    {"revision": 4, "added": ["d"], "changed": [], "removed": ["a"]},
+    {"revision": 5, "added": [], "changed": ["d"], "removed": []},
+]
+MANIFESTS = {
+    0: manifest(0, {}),
+    1: manifest(1, {"a": entry("a1"), "b": entry("b1")}),
+    2: manifest(2, {"a": entry("a2"), "c": entry("c2")}),
+    3: manifest(3, {"a": entry("a2"), "b": entry("b3")}),
+    4: manifest(4, {"b": entry("b3"), "d": entry("d4")}),
+    5: manifest(5, {"b": entry("b3"), "d": entry("d5")}),
+}
+HISTORY = {"revision": 5, "revisions": REVISIONS}
+
+def test_file_removed_then_added_again_is_changed():
+    assert server.compose_changes(HISTORY, 1)["b"] == "changed"
+
+def test_file_added_then_removed_is_left_out():
+    assert "c" not in server.compose_changes(HISTORY, 1)
+
+def test_file_added_then_changed_stays_added():
+    assert server.compose_changes(HISTORY, 3) == {"d": "added", "a": "removed"}
+
+def test_changes_outside_the_history_window_are_not_composed():
+    assert server.compose_changes(HISTORY, 5) == {}
+    assert server.compose_changes(HISTORY, 6) is None
+    trimmed = {"revision": 5, "revisions": REVISIONS[2:]}
+    assert server.compose_changes(trimmed, 2) is not None
+    assert server.compose_changes(trimmed, 1) is None
+
+def test_diff_needs_the_history_of_the_served_manifest():
+    assert server.build_manifest_diff(MANIFESTS[5], None, 1) is None
+    assert server.build_manifest_diff(MANIFESTS[4], HISTORY, 1) is None
+
+def test_diff_folded_into_any_earlier_manifest_gives_the_latest():
+    for since in range(6):
+        diff = server.build_manifest_diff(MANIFESTS[5], HISTORY, since)
+        files_info = apply_manifest_diff(copy.deepcopy(MANIFESTS[since]), diff)
+        assert files_info["files"] == MANIFESTS[5]["files"], since
+        assert files_info["revision"] == 5
@@ -0,0 +1,45 @@
+from werkzeug.http import http_date
+
+import server
+from test_server_wsgi import DATA, STAT, run_wsgi
+
+SIZE = 1000
+ETAG = '"3e8-1"'
+MTIME = 1700000000.5
+
+def resolve(range_header, if_range_header=None):
+    return server.resolve_range(range_header, if_range_header, SIZE, ETAG, MTIME)
+
+def test_byte_ranges():
+    assert resolve(None) == (200, 0, SIZE)
+    assert resolve("bytes=0-99") == (206, 0, 100)
+    assert resolve("bytes=900-") == (206, 900, SIZE)
+    assert resolve("bytes=-100") == (206, 900, SIZE)
+    assert resolve("bytes=900-5000") == (206, 900, SIZE)
+
+def test_unsatisfiable_range():
+    assert resolve("bytes=1000-") == (416, 0, 0)
+
+def test_unsupported_ranges_get_the_whole_file():
+    assert resolve("bytes=0-9,20-29") == (200, 0, SIZE)
+    assert resolve("items=0-9") == (200, 0, SIZE)
+    assert resolve("bytes=garbage") == (200, 0, SIZE)
+
+def test_if_range_etag():
+    assert resolve("bytes=100-", ETAG) == (206, 100, SIZE)
+    assert resolve("bytes=100-", '"3e8-2"') == (200, 0, SIZE)
+
+def test_if_range_date():
+    # HTTP dates have whole seconds
+    assert resolve("bytes=100-", http_date(int(MTIME))) == (206, 100, SIZE)
+    assert resolve("bytes=100-", http_date(int(MTIME) - 1)) == (200, 0, SIZE)
+    assert resolve("bytes=100-", "not a date") == (200, 0, SIZE)
+
+def test_resumed_download_gets_the_rest_of_the_file():
+    etag = server.file_etag(STAT)
+    status, body, _ = run_wsgi(headers={"Range": "bytes=1000-", "If-Range": etag})
+    assert status.startswith("206")
+    assert body == DATA[1000:]
+    status, body, _ = run_wsgi(headers={"Range": "bytes=1000-", "If-Range": '"0-0"'})
+    assert status.startswith("200")
+    assert body == DATA
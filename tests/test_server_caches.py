@@ -0,0 +1,71 @@
+import os
+import gzip
+import json
+import time
+import tempfile
+import threading
+
+import server
+
+def test_update_info_is_hashed_once_for_concurrent_requests():
+    path = os.path.join(tempfile.mkdtemp(), "game_updater.exe")
+    with open(path, "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+    cache = server.UpdateInfoCache(path)
+    builds = []
+    build = cache.build
+
+    def slow_build(stat):
+        builds.append(stat)
+        time.sleep(0.05)
+        return build(stat)
+
+    cache.build = slow_build
+    barrier = threading.Barrier(16)
+
+    def request():
+        barrier.wait()
+        cache.get()
+
+    threads = [threading.Thread(target=request) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+
+    # A new executable is hashed again, once
+    with open(path, "ab") as f:
+        f.write(b"new")
+    assert cache.get().data["files"]["game_updater.exe"]["size"] == 1024 * 1024 + 3
+    assert len(builds) == 2
+    assert cache.get() is cache.get()
+    assert len(builds) == 2
+
+def write_manifest(directory, files):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "files_info.json")
+    with open(path, "w") as f:
+        json.dump({"version": "v", "revision": 1, "files": files}, f)
+    return path
+
+def test_manifest_build_does_not_hold_up_other_projects():
+    root = tempfile.mkdtemp()
+    busy_path = write_manifest(os.path.join(root, "busy"), {})
+    other_path = write_manifest(os.path.join(root, "other"), {"a": {"checksum": "00", "size": 1}})
+    cache = server.ManifestCache()
+    result = []
+    # A manifest being rebuilt holds its own lock for the whole build
+    with cache.build_lock(busy_path):
+        thread = threading.Thread(target=lambda: result.append(cache.get(other_path, "other")))
+        thread.start()
+        thread.join(timeout=5)
+    assert result and result[0].data["files"]["a"]["size"] == 1
+    assert cache.get(busy_path, "busy").data["project_name"] == "busy"
+
+def test_manifest_variants_decode_to_the_manifest():
+    path = write_manifest(tempfile.mkdtemp(), {"a": {"checksum": "00", "size": 1}})
+    manifest = server.ManifestCache().get(path, "p")
+    body = manifest.variants["identity"][0]
+    assert gzip.decompress(manifest.variants["gzip"][0]) == body
+    assert json.loads(body)["files"] == {"a": {"checksum": "00", "size": 1}}
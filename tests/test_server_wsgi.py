@@ -0,0 +1,128 @@
+import os
+import hashlib
+from wsgiref.util import FileWrapper
+
+from werkzeug.test import EnvironBuilder
+
+import server
+
+FILES_DIR = server.FILES_DIR
+PROJECT_DIR = os.path.join(FILES_DIR, "Test Project")
+with open(os.path.join(PROJECT_DIR, "data.bin"), "rb") as f:
+    DATA = f.read()
+CHECKSUM = hashlib.sha256(DATA).hexdigest()
+STAT = os.stat(os.path.join(PROJECT_DIR, "data.bin"))
+
+# Drives the app the way a WSGI server with a file wrapper (gunicorn, wsgiref) does
+def run_wsgi(path="/files/", method="POST", remote_addr="10.0.0.1", headers=None):
+    json_body = {"project": "test", "filename": "data.bin"} if method == "POST" else None
+    environ = EnvironBuilder(
+        path=path, method=method, json=json_body, headers=headers, environ_base={"REMOTE_ADDR": remote_addr},
+    ).get_environ()
+    environ["wsgi.file_wrapper"] = FileWrapper
+    status = []
+    app_iter = server.app(environ, lambda s, headers: status.append(s))
+    try:
+        body = b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return status[0], body, app_iter
+
+def sent_bytes():
+    return server.metrics.bytes_sent.get("test", 0)
+
+def test_zero_copy_download_releases_admission_slot():
+    status, body, app_iter = run_wsgi()
+    assert status.startswith("200")
+    assert isinstance(app_iter, FileWrapper)
+    assert body == DATA
+    assert server.admission.total == 0
+    assert server.admission.active == {}
+
+def test_zero_copy_downloads_are_not_rejected_past_the_client_limit():
+    for _ in range(server.MAX_CLIENT_STREAMS + 1):
+        status, _, _ = run_wsgi(remote_addr="10.0.0.2")
+        assert status.startswith("200")
+    assert server.admission.total == 0
+
+def test_clients_behind_a_trusted_proxy_are_limited_separately(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", 1)
+    # Holds every stream the player at 192.0.2.1 may open
+    for _ in range(server.MAX_CLIENT_STREAMS):
+        assert server.admission.acquire("192.0.2.1") is None
+    try:
+        status, _, _ = run_wsgi(remote_addr="10.0.0.3", headers={"X-Forwarded-For": "192.0.2.2"})
+        assert status.startswith("200")
+        status, _, _ = run_wsgi(remote_addr="10.0.0.3", headers={"X-Forwarded-For": "192.0.2.1"})
+        assert status.startswith("503")
+        # Addresses the player put in front of the proxy's are not trusted
+        status, _, _ = run_wsgi(remote_addr="10.0.0.3", headers={"X-Forwarded-For": "192.0.2.2, 192.0.2.1"})
+        assert status.startswith("503")
+    finally:
+        for _ in range(server.MAX_CLIENT_STREAMS):
+            server.admission.release("192.0.2.1")
+    assert server.admission.total == 0
+
+def test_forwarded_addresses_are_ignored_without_trusted_proxies():
+    assert server.client_address("10.0.0.3", "192.0.2.1") == "10.0.0.3"
+
+def test_zero_copy_download_is_recorded_in_metrics():
+    before = sent_bytes()
+    streams = server.metrics.streams
+    run_wsgi()
+    assert sent_bytes() - before == 64 * 1024
+    assert server.metrics.streams == streams + 1
+    assert server.metrics.active_streams == 0
+
+def test_head_request_counts_no_bytes():
+    before = server.metrics.bytes_sent.get(None, 0)
+    status, body, _ = run_wsgi(path=f"/blobs/{CHECKSUM}", method="HEAD")
+    assert status.startswith("200")
+    assert body == b""
+    assert server.metrics.bytes_sent.get(None, 0) == before
+    assert server.admission.total == 0
+
+def test_blob_is_served_from_the_project_file():
+    status, body, _ = run_wsgi(path=f"/blobs/{CHECKSUM}", method="GET")
+    assert status.startswith("200")
+    assert body == DATA
+
+def test_blob_of_a_file_changed_since_its_manifest_is_not_served():
+    file_path = os.path.join(PROJECT_DIR, "data.bin")
+    os.utime(file_path, ns=(STAT.st_atime_ns, STAT.st_mtime_ns + 1))
+    try:
+        status, _, _ = run_wsgi(path=f"/blobs/{CHECKSUM}", method="GET")
+    finally:
+        os.utime(file_path, ns=(STAT.st_atime_ns, STAT.st_mtime_ns))
+    assert status.startswith("404")
+
+def post_json(path, body):
+    environ = EnvironBuilder(path=path, method="POST", json=body).get_environ()
+    status = []
+    app_iter = server.app(environ, lambda s, headers: status.append(s))
+    try:
+        return status[0], b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+
+def test_file_names_outside_the_project_are_refused():
+    for filename in ("../project_data.json", os.path.join(FILES_DIR, "project_data.json"), "/etc/passwd", "", "."):
+        status, _ = post_json("/files/", {"project": "test", "filename": filename})
+        assert status.startswith("404"), filename
+
+def test_bundle_refuses_names_outside_the_project():
+    status, _ = post_json("/bundle/", {"project": "test", "filenames": ["data.bin", "../project_data.json"]})
+    assert status.startswith("404")
+    status, _ = post_json("/bundle/", {"project": "test", "filenames": ["/etc/passwd"]})
+    assert status.startswith("404")
+
+def test_symlink_out_of_the_project_is_refused():
+    link = os.path.join(PROJECT_DIR, "outside.json")
+    os.symlink(os.path.join(FILES_DIR, "project_data.json"), link)
+    try:
+        status, _ = post_json("/files/", {"project": "test", "filename": "outside.json"})
+    finally:
+        os.remove(link)
+    assert status.startswith("404")
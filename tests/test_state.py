@@ -0,0 +1,43 @@
+import os
+
+from state import CompletedFiles
+
+def journal_of(project_dir):
+    return os.path.join(project_dir, "completed_files.journal")
+
+def test_entries_survive_a_reload(tmp_path):
+    completed = CompletedFiles(str(tmp_path))
+    completed.set("a.bin", "a1")
+    completed.set("b.bin", "b1")
+    completed.set("a.bin", "a2")
+    completed.flush()
+    completed.journal.close()
+    reloaded = CompletedFiles(str(tmp_path))
+    assert reloaded.files == {"a.bin": "a2", "b.bin": "b1"}
+
+def test_torn_journal_tail_is_dropped_and_cut_off(tmp_path):
+    with open(journal_of(tmp_path), "w") as f:
+        f.write('["a.bin", "a1"]\n["b.bin", "b1"]\n["c.bin", "c')
+    completed = CompletedFiles(str(tmp_path))
+    assert completed.files == {"a.bin": "a1", "b.bin": "b1"}
+    assert os.path.getsize(journal_of(tmp_path)) == len('["a.bin", "a1"]\n["b.bin", "b1"]\n')
+    # New entries start on a line of their own
+    completed.set("c.bin", "c1")
+    completed.close()
+    assert CompletedFiles(str(tmp_path)).files == {"a.bin": "a1", "b.bin": "b1", "c.bin": "c1"}
+
+def test_last_line_without_newline_is_not_trusted(tmp_path):
+    # Parses as JSON, but the checksum may have been cut short
+    with open(journal_of(tmp_path), "w") as f:
+        f.write('["a.bin", "a1"]\n["b.bin", "b1"]')
+    assert CompletedFiles(str(tmp_path)).files == {"a.bin": "a1"}
+
+def test_journal_replays_over_the_snapshot(tmp_path):
+    completed = CompletedFiles(str(tmp_path))
+    completed.set("a.bin", "a1")
+    completed.compact()
+    completed.set("a.bin", "a2")
+    completed.set("b.bin", "b1")
+    completed.flush()
+    completed.journal.close()
+    assert CompletedFiles(str(tmp_path)).files == {"a.bin": "a2", "b.bin": "b1"}
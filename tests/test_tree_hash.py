@@ -0,0 +1,55 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import generate_files_info
+from integrity import TreeHasher, hash_file, new_hasher
+
+CHUNK_SIZE = generate_files_info.BLOCK_SIZE
+
+@pytest.fixture
+def big_file(tmp_path, monkeypatch):
+    # Tree hashed in block-sized chunks, with a short last chunk
+    monkeypatch.setattr(generate_files_info, "TREE_HASH_MIN_SIZE", CHUNK_SIZE)
+    monkeypatch.setattr(generate_files_info, "TREE_CHUNK_SIZE", CHUNK_SIZE)
+    file_path = tmp_path / "big.bin"
+    file_path.write_bytes(os.urandom(CHUNK_SIZE * 2 + CHUNK_SIZE // 2))
+    return str(file_path)
+
+def test_generator_tree_hash_is_sha256_over_chunk_digests(big_file):
+    file_info = generate_files_info.generate_checksum_for_file(big_file)
+    assert file_info["hash_algorithm"] == "sha256-tree"
+    assert file_info["hash_chunk_size"] == CHUNK_SIZE
+    with open(big_file, "rb") as f:
+        digests = [hashlib.sha256(chunk).digest() for chunk in iter(lambda: f.read(CHUNK_SIZE), b"")]
+    assert file_info["checksum"] == hashlib.sha256(b"".join(digests)).hexdigest()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert generate_files_info.generate_checksum_for_file(big_file, pool)["checksum"] == file_info["checksum"]
+
+def test_client_hashes_match_the_generator(big_file):
+    file_info = generate_files_info.generate_checksum_for_file(big_file)
+    assert hash_file(big_file, file_info) == file_info["checksum"]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert hash_file(big_file, file_info, pool) == file_info["checksum"]
+
+def test_streamed_tree_hash_matches_in_any_pieces(big_file):
+    file_info = generate_files_info.generate_checksum_for_file(big_file)
+    with open(big_file, "rb") as f:
+        data = f.read()
+    # Pieces that straddle chunk boundaries, and pieces that end exactly on them
+    for piece_size in (1000, 4096, CHUNK_SIZE, CHUNK_SIZE + 1, len(data)):
+        hasher = new_hasher(file_info)
+        assert isinstance(hasher, TreeHasher)
+        for start in range(0, len(data), piece_size):
+            hasher.update(data[start:start + piece_size])
+        assert hasher.hexdigest() == file_info["checksum"], piece_size
+
+def test_small_files_keep_a_plain_sha256(tmp_path):
+    file_path = tmp_path / "small.bin"
+    data = os.urandom(1000)
+    file_path.write_bytes(data)
+    file_info = generate_files_info.generate_checksum_for_file(str(file_path))
+    assert "hash_algorithm" not in file_info
+    assert file_info["checksum"] == hashlib.sha256(data).hexdigest() == hash_file(str(file_path), file_info)
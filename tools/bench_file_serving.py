@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# Compares the server's chunked file_generator against handing the file to the kernel with
+# os.sendfile. Each mode pushes the same file over a local socket to a draining child process,
+# so the measured CPU time belongs to the sending side only.
+
+def drain(sock):
+    buffer = bytearray(1024 * 1024)
+    while sock.recv_into(buffer):
+        pass
+    sock.close()
+
+def send_with_generator(file_path, sock, chunk_size):
+    # Same loop the Flask route runs when no wsgi.file_wrapper is available
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sock.sendall(chunk)
+
+def send_with_sendfile(file_path, sock, chunk_size):
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+MODES = {
+    "generator-8k": (send_with_generator, 8192),
+    "generator-256k": (send_with_generator, 256 * 1024),
+    "sendfile": (send_with_sendfile, 0),
+}
+
+def run_mode(name, file_path):
+    send, chunk_size = MODES[name]
+    sender, receiver = socket.socketpair()
+    reader = multiprocessing.get_context("fork").Process(target=drain, args=(receiver,))
+    reader.start()
+    receiver.close()
+
+    size = os.path.getsize(file_path)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    send(file_path, sender, chunk_size)
+    sender.shutdown(socket.SHUT_WR)
+    cpu = time.process_time() - start_cpu
+    reader.join()
+    wall = time.perf_counter() - start_wall
+    sender.close()
+
+    gigabytes = size / (1024 ** 3)
+    return {
+        "mode": name,
+        "bytes": size,
+        "seconds": round(wall, 4),
+        "mb_per_s": round(size / (1024 * 1024) / wall, 1),
+        "cpu_seconds_per_gb": round(cpu / gigabytes, 3),
+    }
+
+def make_test_file(directory, size_mb):
+    file_path = os.path.join(directory, "bench.bin")
+    block = os.urandom(1024 * 1024)
+    with open(file_path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+    return file_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file serving modes")
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    if not hasattr(os, "sendfile") and "sendfile" in args.modes:
+        logger.warning("os.sendfile is not available on this platform, skipping it")
+        args.modes.remove("sendfile")
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = make_test_file(directory, args.size_mb)
+        for name in args.modes:
+            # Keep the best run, the first one mostly measures the page cache warming up
+            runs = [run_mode(name, file_path) for _ in range(args.repeat)]
+            results.append(max(runs, key=lambda result: result["mb_per_s"]))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+        return
+    for result in results:
+        logger.info(
+            f"{result['mode']:>15}: {result['mb_per_s']:>8.1f} MB/s, "
+            f"{result['cpu_seconds_per_gb']:.3f} CPU s/GB"
+        )
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
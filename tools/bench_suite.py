@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# End-to-end benchmarks on a synthetic content tree: manifest generation with the Python and
+# Rust tools (full and incremental run), the server under a concurrent load generator and a
+# headless client update against it. Everything runs as real processes on localhost and the
+# results are printed as one JSON document, so runs can be diffed to catch regressions.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PYTHON_GENERATOR = os.path.join(REPO_DIR, "tools", "generate_files_info.py")
+RUST_GENERATOR = os.path.join(REPO_DIR, "tools", "checksum_generator", "target", "release", "checksum_generator")
+PROJECT_NAME = "bench"
+
+SERVERS = {
+    # server/__init__.py's own __main__ always passes an ssl_context, run the app directly instead
+    "flask": lambda port: [
+        sys.executable, "-c", f"import server; server.app.run(host='127.0.0.1', port={port}, threaded=True)"
+    ],
+    "aio": lambda port: [sys.executable, "-m", "server.aio"],
+}
+
+def file_sizes(count, distribution, mean_size, max_size, rng):
+    if distribution == "fixed":
+        return [mean_size] * count
+    if distribution == "uniform":
+        return [rng.randint(0, min(2 * mean_size, max_size)) for _ in range(count)]
+    # Lognormal: mostly small files with a long tail of big ones, like typical game data
+    sigma = 1.5
+    mu = math.log(mean_size) - sigma ** 2 / 2
+    return [min(int(rng.lognormvariate(mu, sigma)), max_size) for _ in range(count)]
+
+def build_tree(directory, count, distribution, mean_size, max_size, seed):
+    rng = random.Random(seed)
+    project_dir = os.path.join(directory, PROJECT_NAME)
+    total = 0
+    for index, size in enumerate(file_sizes(count, distribution, mean_size, max_size, rng)):
+        file_path = os.path.join(project_dir, f"dir{index % 64:02d}", f"file{index}.bin")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = rng.randbytes(min(remaining, 1024 * 1024))
+                f.write(chunk)
+                remaining -= len(chunk)
+        total += size
+    return {"files": count, "bytes": total, "distribution": distribution, "seed": seed}
+
+def run_generator(command, base_path, project_data_path, incremental):
+    env = {
+        **os.environ,
+        "BASE_PATH": base_path,
+        "PROJECT_DATA_PATH": project_data_path,
+        "INCREMENTAL": "1" if incremental else "0",
+    }
+    start = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return round(time.perf_counter() - start, 4)
+
+def bench_generators(base_path, project_data_path, rust_binary):
+    tools = [("python", [sys.executable, PYTHON_GENERATOR])]
+    if rust_binary and os.path.exists(rust_binary):
+        tools.append(("rust", [rust_binary]))
+    elif rust_binary:
+        logger.warning(f"Rust generator not found at {rust_binary}, build it with cargo build --release")
+    results = []
+    # The Python tool runs last, so the manifests the server benchmarks see are its output
+    for name, command in reversed(tools):
+        logger.info(f"Timing the {name} generator")
+        results.append({
+            "tool": name,
+            "full_seconds": run_generator(command, base_path, project_data_path, False),
+            "incremental_seconds": run_generator(command, base_path, project_data_path, True),
+        })
+    return results
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(kind, files_dir, project_data_path):
+    port = free_port()
+    env = {**os.environ, "FILES_DIR": files_dir, "PROJECT_DATA": project_data_path, "PORT": str(port)}
+    # All load comes from one address, the per-client stream limit would only measure itself
+    env.setdefault("MAX_CLIENT_STREAMS", str(1 << 20))
+    process = subprocess.Popen(
+        SERVERS[kind](port), cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/status/", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{kind} server did not come up on port {port}")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run_load(scenario, url, plan, concurrency, duration):
+    # Every worker owns a session (keep-alive) and walks the request plan until the time is up
+    latencies = []
+    counters = {"bytes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(offset):
+        session = requests.Session()
+        index = offset
+        while time.perf_counter() < deadline:
+            method, path, payload = plan[index % len(plan)]
+            index += concurrency
+            start = time.perf_counter()
+            size = 0
+            try:
+                with session.request(method, f"{url}{path}", json=payload, stream=True) as response:
+                    for chunk in response.iter_content(chunk_size=256 * 1024):
+                        size += len(chunk)
+                    ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                    counters["bytes"] += size
+                else:
+                    counters["errors"] += 1
+        session.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": counters["errors"],
+        "requests_per_s": round(len(latencies) / wall, 1),
+        "mb_per_s": round(counters["bytes"] / (1024 * 1024) / wall, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+def bench_server(url, project, file_names, concurrency, duration, seed):
+    rng = random.Random(seed)
+    files_plan = [
+        ("POST", "/files/", {"project": project, "filename": file_name})
+        for file_name in rng.sample(file_names, len(file_names))
+    ]
+    return [
+        run_load("files", url, files_plan, concurrency, duration),
+        run_load("files_info", url, [("GET", f"/files_info/{project}/", None)], concurrency, duration),
+    ]
+
+def bench_client(url, project, directory):
+    # The client modules import each other by name, as they do when run from client/
+    sys.path.insert(0, os.path.join(REPO_DIR, "client"))
+    from downloader import DownloadProgress
+    from sync import sync_project
+
+    results = []
+    # A cold run streams the paged manifest and downloads everything, the warm one fetches the
+    # manifest changes and only verifies what is already there
+    for run in ("cold", "warm"):
+        progress = DownloadProgress()
+        start = time.perf_counter()
+        files_info, pending = sync_project(url, project, directory, log=lambda message: None, progress=progress)
+        elapsed = time.perf_counter() - start
+        done, _, _ = progress.snapshot()
+        results.append({
+            "run": run,
+            "seconds": round(elapsed, 4),
+            "files": len(files_info["files"]),
+            "downloaded_files": len(pending),
+            "bytes": done,
+            "mb_per_s": round(done / (1024 * 1024) / elapsed, 1),
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark manifest generation, serving and client updates")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--mean-size", type=int, default=256 * 1024, help="mean file size in bytes")
+    parser.add_argument("--max-size", type=int, default=256 * 1024 * 1024, help="largest file size in bytes")
+    parser.add_argument("--distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--servers", nargs="+", choices=list(SERVERS), default=["flask"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per load scenario")
+    parser.add_argument("--rust-binary", default=RUST_GENERATOR)
+    parser.add_argument("--skip", nargs="+", choices=["server", "client"], default=[])
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        files_dir = os.path.join(directory, "files")
+        project_data_path = os.path.join(directory, "project_data.json")
+
+        logger.info(f"Building {args.files} files ({args.distribution})")
+        start = time.perf_counter()
+        results["tree"] = build_tree(files_dir, args.files, args.distribution, args.mean_size, args.max_size, args.seed)
+        results["tree"]["build_seconds"] = round(time.perf_counter() - start, 4)
+
+        results["generators"] = bench_generators(files_dir, project_data_path, args.rust_binary)
+
+        with open(project_data_path, "r") as f:
+            project = next(key for key, value in json.load(f).items() if value == PROJECT_NAME)
+        with open(os.path.join(files_dir, PROJECT_NAME, "files_info.json"), "r") as f:
+            file_names = sorted(json.load(f)["files"])
+
+        results["servers"] = {}
+        for kind in args.servers:
+            process, url = start_server(kind, files_dir, project_data_path)
+            try:
+                server_results = {}
+                if "server" not in args.skip:
+                    logger.info(f"Load testing the {kind} server")
+                    server_results["load"] = bench_server(
+                        url, project, file_names, args.concurrency, args.duration, args.seed
+                    )
+                if "client" not in args.skip:
+                    logger.info(f"Running a headless client update against the {kind} server")
+                    server_results["client"] = bench_client(url, project, os.path.join(directory, f"client-{kind}"))
+                results["servers"][kind] = server_results
+            finally:
+                stop_server(process)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
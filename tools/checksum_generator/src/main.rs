@@ -10,11 +10,31 @@ use log::{info};
 use env_logger;
 use uuid::Uuid;
 
-#[derive(Serialize, Deserialize)]
+const MANIFEST_FILES: [&str; 3] = ["files_info.json", "block_signatures.json", "manifest_history.json"];
+const COMPRESSED_DIR: &str = ".compressed";
+// Paged manifest written by generate_files_info.py. Its index records the files_info.json it was
+// made from, so the server stops serving it once this tool has replaced that file
+const MANIFEST_DIR: &str = ".manifest";
+// Content-addressed store kept by generate_files_info.py, not a project
+const BLOBS_DIR: &str = ".blobs";
+
+// INCREMENTAL=0 rehashes every file instead of reusing unchanged entries of the previous manifest
+fn incremental() -> bool {
+    std::env::var("INCREMENTAL").map(|value| value != "0").unwrap_or(true)
+}
+
+#[derive(Serialize, Deserialize, Clone)]
 struct FileInfo {
     checksum: String,
-    last_modified: u64,
+    #[serde(default)]
+    size: u64,
+    last_modified: f64,
+    #[serde(default)]
+    last_modified_ns: u64,
     last_modified_human: String,
+    // Fields written by the Python generator (block_size, ...) survive when an entry is reused
+    #[serde(flatten)]
+    extra: HashMap<String, serde_json::Value>,
 }
 
 #[derive(Serialize, Deserialize)]
@@ -25,59 +45,110 @@ struct FilesInfo {
 
 fn generate_checksum_for_file(file_path: &Path) -> io::Result<FileInfo> {
     info!("Generating checksum for file {:?}", file_path);
-    let file = File::open(file_path)?;
+    // Stat before reading, a file modified while hashing is then picked up by the next run
+    let metadata = fs::metadata(file_path)?;
+    let mut reader = File::open(file_path)?;
     let mut hasher = Sha256::new();
-    let mut buffer = [0; 4096];
-    let mut reader = io::BufReader::new(file);
+    // Large direct reads, a BufReader in front of them would only add a copy
+    let mut buffer = vec![0; 1024 * 1024];
     while let Ok(n) = reader.read(&mut buffer) {
         if n == 0 { break; }
         hasher.update(&buffer[..n]);
     }
     let result = hasher.finalize();
-    let metadata = fs::metadata(file_path)?;
-    let modified_time = metadata.modified()?.duration_since(UNIX_EPOCH).unwrap_or_else(|_| std::time::Duration::from_secs(0)).as_secs();
+    let modified = metadata.modified()?.duration_since(UNIX_EPOCH).unwrap_or_else(|_| std::time::Duration::from_secs(0));
     let modified_time_human: std::time::SystemTime = metadata.modified()?.into();
     Ok(FileInfo {
         checksum: format!("{:x}", result),
-        last_modified: modified_time,
+        size: metadata.len(),
+        last_modified: modified.as_secs_f64(),
+        last_modified_ns: modified.as_nanos() as u64,
         last_modified_human: format!("{:?}", modified_time_human),
+        extra: HashMap::new(),
     })
 }
 
-fn generate_checksums(path: &Path) -> io::Result<HashMap<String, FileInfo>> {
+fn modified_ns(metadata: &fs::Metadata) -> Option<u64> {
+    let modified = metadata.modified().ok()?.duration_since(UNIX_EPOCH).ok()?;
+    Some(modified.as_nanos() as u64)
+}
+
+// Reuse the previous entry when the file's size and mtime_ns are unchanged
+fn reusable_entry(previous: Option<&FileInfo>, metadata: &fs::Metadata) -> Option<FileInfo> {
+    let previous = previous?;
+    if previous.size == metadata.len() && Some(previous.last_modified_ns) == modified_ns(metadata) {
+        Some(previous.clone())
+    } else {
+        None
+    }
+}
+
+fn load_previous_files(output_file: &Path) -> HashMap<String, FileInfo> {
+    fs::read_to_string(output_file)
+        .ok()
+        .and_then(|data| serde_json::from_str::<FilesInfo>(&data).ok())
+        .map(|files_info| files_info.files)
+        .unwrap_or_default()
+}
+
+fn generate_checksums(path: &Path, previous: &HashMap<String, FileInfo>) -> io::Result<HashMap<String, FileInfo>> {
     let mut checksums = HashMap::new();
     if path.is_file() {
         if let Ok(file_info) = generate_checksum_for_file(path) {
             checksums.insert(path.file_name().unwrap().to_string_lossy().to_string(), file_info);
         }
     } else {
-        for entry in WalkDir::new(path) {
+        let (mut reused, mut hashed) = (0, 0);
+        // Pre-compressed sidecars and manifest pages written by generate_files_info.py are not content
+        let walker = WalkDir::new(path)
+            .into_iter()
+            .filter_entry(|entry| {
+                !(entry.depth() == 1 && (entry.file_name() == COMPRESSED_DIR || entry.file_name() == MANIFEST_DIR))
+            });
+        for entry in walker {
             let entry = entry?;
             if entry.file_type().is_file() {
-                if entry.file_name() == "files_info.json" {
+                if MANIFEST_FILES.iter().any(|name| entry.file_name() == *name) {
+                    continue;
+                }
+                let relative_path = entry.path().strip_prefix(path).unwrap().to_string_lossy().to_string();
+                let metadata = entry.metadata()?;
+                if let Some(file_info) = reusable_entry(previous.get(&relative_path), &metadata) {
+                    checksums.insert(relative_path, file_info);
+                    reused += 1;
                     continue;
                 }
                 if let Ok(file_info) = generate_checksum_for_file(entry.path()) {
-                    let relative_path = entry.path().strip_prefix(path).unwrap().to_string_lossy().to_string();
                     checksums.insert(relative_path, file_info);
+                    hashed += 1;
                 }
             }
         }
+        let mut removed = 0;
+        for file_name in previous.keys().filter(|file_name| !checksums.contains_key(*file_name)) {
+            info!("Removed file {}", file_name);
+            removed += 1;
+        }
+        info!("{} files unchanged, {} hashed, {} removed", reused, hashed, removed);
     }
     Ok(checksums)
 }
 
 fn save_files_info(project_path: &Path) -> io::Result<()> {
     let output_file = project_path.join("files_info.json");
-    let checksums = generate_checksums(project_path)?;
+    let previous = if incremental() { load_previous_files(&output_file) } else { HashMap::new() };
+    let checksums = generate_checksums(project_path, &previous)?;
 
     let files_info = FilesInfo {
         version: project_path.file_name().unwrap().to_string_lossy().to_string(),
         files: checksums,
     };
 
-    let json_data = serde_json::to_string_pretty(&files_info)?;
-    fs::write(output_file.clone(), json_data)?;
+    // Write next to the target and rename, the server never sees a half-written manifest
+    let json_data = serde_json::to_string(&files_info)?;
+    let temp_file = project_path.join("files_info.json.tmp");
+    fs::write(&temp_file, json_data)?;
+    fs::rename(&temp_file, &output_file)?;
 
     info!("Saved files_info.json to {:?}", output_file.clone());
     Ok(())
@@ -106,6 +177,9 @@ fn main() -> io::Result<()> {
     for entry in fs::read_dir(base_directory)? {
         let entry = entry?;
         let path = entry.path();
+        if entry.file_name() == BLOBS_DIR {
+            continue;
+        }
         if path.is_dir() {
             info!("Generating files_info.json for project {:?}", path);
             save_files_info(&path)?;
@@ -4,7 +4,15 @@ import hashlib
 import logging
 import uuid
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zlib
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import dotenv
 dotenv.load_dotenv()
@@ -13,38 +21,172 @@ logger = logging.getLogger(__name__)
 
 BASE_PATH = os.getenv("BASE_PATH") or ""
 PROJECT_DATA_PATH = os.getenv("PROJECT_DATA_PATH") or ""
+BLOCK_SIZE = int(os.getenv("BLOCK_SIZE") or 0) or 1024 * 1024
+BLOCK_SIGNATURE_MIN_SIZE = int(os.getenv("BLOCK_SIGNATURE_MIN_SIZE") or 0) or 16 * 1024 * 1024
+MANIFEST_FILES = ("files_info.json", "block_signatures.json", "manifest_history.json")
+# Revisions whose change lists are kept in manifest_history.json for the server's diff endpoint
+MANIFEST_HISTORY = int(os.getenv("MANIFEST_HISTORY") or 0) or 100
+# Entry fields a client acts on, a change in any of them makes a new manifest revision
+CHANGE_KEYS = ("checksum", "size", "block_size", "hash_algorithm", "hash_chunk_size")
+# Reuse entries of the previous files_info.json whose size and mtime_ns did not change
+INCREMENTAL = (os.getenv("INCREMENTAL") or "1") != "0"
+# Files of at least TREE_HASH_MIN_SIZE get a chunked tree hash: sha256 over the sha256 digests of
+# consecutive TREE_CHUNK_SIZE chunks, so one huge file is hashed on every core. The chunk size is
+# kept a multiple of BLOCK_SIZE. HASH_PROCESSES > 0 hashes the chunks on a process pool instead of threads
+TREE_HASH = (os.getenv("TREE_HASH") or "1") != "0"
+TREE_HASH_ALGORITHM = "sha256-tree"
+TREE_HASH_MIN_SIZE = int(os.getenv("TREE_HASH_MIN_SIZE") or 0) or 1024 * 1024 * 1024
+TREE_CHUNK_SIZE = max(1, (int(os.getenv("TREE_CHUNK_SIZE") or 0) or 64 * 1024 * 1024) // BLOCK_SIZE) * BLOCK_SIZE
+HASH_PROCESSES = int(os.getenv("HASH_PROCESSES") or 0)
+# COMPRESS=1 stores gzip (and zstd when available) copies of files of COMPRESS_MIN_SIZE up to
+# COMPRESS_MAX_SIZE under <project>/.compressed/, keeping a variant only when it saves
+# COMPRESS_MIN_SAVING of the size. Encoded downloads cannot be resumed, so larger files are always
+# sent as they are. Sidecars carry their source's mtime, which is how the server tells them from stale ones
+COMPRESS = (os.getenv("COMPRESS") or "0") != "0"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE") or 0) or 4096
+COMPRESS_MAX_SIZE = int(os.getenv("COMPRESS_MAX_SIZE") or 0) or 64 * 1024 * 1024
+COMPRESS_MIN_SAVING = float(os.getenv("COMPRESS_MIN_SAVING") or 0) or 0.1
+COMPRESSED_DIR = ".compressed"
+ENCODING_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+# Blob store of earlier versions, never a project; the server now serves /blobs/ from the project files
+BLOBS_DIR = ".blobs"
+# Besides files_info.json every project gets a paged copy of its manifest under .manifest/:
+# index.json and pages of MANIFEST_PAGE_SIZE entries, one ["path", {entry}] JSON line each, in
+# path order, plus a gzip copy of each. Page files are named <generation>-<page>.ndjson so a new set never overwrites the
+# one clients are still reading; the previous generation is kept, older ones are removed
+MANIFEST_DIR = ".manifest"
+MANIFEST_PAGE_SIZE = int(os.getenv("MANIFEST_PAGE_SIZE") or 0) or 10000
+# Directories at the top of a project that hold generated data, not content
+GENERATED_DIRS = (COMPRESSED_DIR, MANIFEST_DIR)
 
 if not BASE_PATH and BASE_PATH is not None and not os.path.exists(BASE_PATH):
     raise ValueError("BASE_PATH is not set in .env")
 if not PROJECT_DATA_PATH and PROJECT_DATA_PATH is not None and not os.path.exists(PROJECT_DATA_PATH):
     raise ValueError("PROJECT_DATA_PATH is not set in .env")
 
-def generate_checksum_for_file(file_path):
-    logger.info(f"Generating checksum for file {file_path}")
+def hash_range(file_path, start, length, with_blocks=False, buffer_size=BLOCK_SIZE):
+    # Reads in BLOCK_SIZE steps into one reusable buffer; hashlib and adler32 drop the GIL on
+    # large buffers, so ranges hashed on a thread pool really run in parallel
     sha256 = hashlib.sha256()
+    weak = []
+    strong = []
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        f.seek(start)
+        while length > 0:
+            size = f.readinto(view[:min(buffer_size, length)])
+            if not size:
+                break
+            length -= size
+            chunk = view[:size]
+            sha256.update(chunk)
+            if with_blocks:
+                weak.append(zlib.adler32(chunk))
+                strong.append(hashlib.sha256(chunk).hexdigest())
+    return sha256.digest(), weak, strong
+
+def generate_checksum_for_file(file_path, chunk_executor=None):
+    logger.info(f"Generating checksum for file {file_path}")
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256.update(chunk)
-        return {
-            "checksum": sha256.hexdigest(),
-            "last_modified": os.path.getmtime(file_path),
-            "last_modified_human": time.ctime(os.path.getmtime(file_path))
+        # Stat before reading, a file modified while hashing is then picked up by the next run
+        stat = os.stat(file_path)
+        size = stat.st_size
+        # Large files also get per-block weak/strong hashes so clients can patch them in place
+        with_blocks = size >= BLOCK_SIGNATURE_MIN_SIZE
+        tree = uses_tree_hash(size)
+        if tree:
+            # Chunks are hashed independently across the pool, the checksum is the sha256 of
+            # their concatenated digests. Chunks are whole blocks, so block hashes line up too
+            ranges = [(start, min(TREE_CHUNK_SIZE, size - start)) for start in range(0, size, TREE_CHUNK_SIZE)]
+            if chunk_executor is None:
+                results = [hash_range(file_path, start, length, with_blocks) for start, length in ranges]
+            else:
+                futures = [
+                    chunk_executor.submit(hash_range, file_path, start, length, with_blocks)
+                    for start, length in ranges
+                ]
+                results = [future.result() for future in futures]
+            checksum = hashlib.sha256(b"".join(digest for digest, _, _ in results)).hexdigest()
+            weak = [value for _, chunk_weak, _ in results for value in chunk_weak]
+            strong = [value for _, _, chunk_strong in results for value in chunk_strong]
+        else:
+            digest, weak, strong = hash_range(file_path, 0, size, with_blocks)
+            checksum = digest.hex()
+        result = {
+            "checksum": checksum,
+            "size": size,
+            "last_modified": stat.st_mtime,
+            "last_modified_ns": stat.st_mtime_ns,
+            "last_modified_human": time.ctime(stat.st_mtime)
         }
+        if tree:
+            result["hash_algorithm"] = TREE_HASH_ALGORITHM
+            result["hash_chunk_size"] = TREE_CHUNK_SIZE
+        if with_blocks:
+            result["block_size"] = BLOCK_SIZE
+            result["blocks"] = {"size": size, "weak": weak, "strong": strong}
+        return result
     except Exception as e:
         logger.error(f"Error generating checksum for file {file_path}: {e}")
         return None
 
-def generate_checksums(path):
+def uses_tree_hash(size):
+    return TREE_HASH and size >= TREE_HASH_MIN_SIZE
+
+def create_chunk_executor():
+    # Tree hash chunks run on their own pool, file tasks waiting on them never starve it
+    if HASH_PROCESSES:
+        return ProcessPoolExecutor(max_workers=HASH_PROCESSES)
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def reusable_entry(previous, stat):
+    if previous is None:
+        return None
+    if previous.get("size") != stat.st_size or previous.get("last_modified_ns") != stat.st_mtime_ns:
+        return None
+    # Block signatures must exist exactly when the current settings ask for them
+    if ("block_size" in previous) != (stat.st_size >= BLOCK_SIGNATURE_MIN_SIZE):
+        return None
+    if "block_size" in previous and (previous["block_size"] != BLOCK_SIZE or "blocks" not in previous):
+        return None
+    # Same for the tree hash and its chunk size
+    if uses_tree_hash(stat.st_size):
+        if previous.get("hash_algorithm") != TREE_HASH_ALGORITHM or previous.get("hash_chunk_size") != TREE_CHUNK_SIZE:
+            return None
+    elif "hash_algorithm" in previous:
+        return None
+    return previous
+
+def generate_checksums(path, previous=None):
+    previous = previous or {}
     checksums = {}
     if os.path.isfile(path):
-        result = generate_checksum_for_file(path)
+        with create_chunk_executor() as chunk_executor:
+            result = generate_checksum_for_file(path, chunk_executor)
         if result:
             checksums[os.path.basename(path)] = result
     else:
-        with ThreadPoolExecutor() as executor:
-            future_to_file = {executor.submit(generate_checksum_for_file, os.path.join(root, file)): os.path.join(root, file)
-                            for root, _, files in os.walk(path) for file in files if file != "files_info.json"}
+        reused = 0
+        with create_chunk_executor() as chunk_executor, ThreadPoolExecutor() as executor:
+            future_to_file = {}
+            for root, dirs, files in os.walk(path):
+                if root == path:
+                    dirs[:] = [name for name in dirs if name not in GENERATED_DIRS]
+                for file in files:
+                    if file in MANIFEST_FILES:
+                        continue
+                    file_path = os.path.join(root, file)
+                    relative_path = os.path.relpath(file_path, path)
+                    try:
+                        entry = reusable_entry(previous.get(relative_path), os.stat(file_path))
+                    except OSError:
+                        entry = None
+                    if entry is not None:
+                        checksums[relative_path] = entry
+                        reused += 1
+                    else:
+                        future_to_file[executor.submit(generate_checksum_for_file, file_path, chunk_executor)] = file_path
             for future in as_completed(future_to_file):
                 file_path = future_to_file[future]
                 try:
@@ -54,19 +196,241 @@ def generate_checksums(path):
                         checksums[relative_path] = result
                 except Exception as e:
                     logger.error(f"Error processing file {file_path}: {e}")
+        removed = [file_name for file_name in previous if file_name not in checksums]
+        for file_name in removed:
+            logger.info(f"Removed file {file_name}")
+        logger.info(f"{reused} files unchanged, {len(future_to_file)} hashed, {len(removed)} removed")
     return checksums
 
+def compressors():
+    # Moderate levels: the highest ones are many times slower for a few percent on a first publish
+    compressors = {"gzip": lambda target: gzip.GzipFile(fileobj=target, mode="wb", compresslevel=6, mtime=0)}
+    if zstandard is not None:
+        compressors["zstd"] = lambda target: zstandard.ZstdCompressor(level=9).stream_writer(target)
+    return compressors
+
+def sidecar_path(project_path, relative_path, encoding):
+    return os.path.join(project_path, COMPRESSED_DIR, relative_path + ENCODING_SUFFIXES[encoding])
+
+def valid_sidecars(project_path, relative_path, file_info):
+    encodings = {}
+    for encoding in file_info.get("encodings", {}):
+        try:
+            stat = os.stat(sidecar_path(project_path, relative_path, encoding))
+        except FileNotFoundError:
+            return None
+        if stat.st_mtime_ns != file_info["last_modified_ns"]:
+            return None
+        encodings[encoding] = stat.st_size
+    return encodings
+
+def compress_file(project_path, relative_path, file_info):
+    # Returns {encoding: compressed size} of the sidecars worth serving; an empty dict records
+    # that the file was tried, so unchanged files are not compressed again on every run
+    source_path = os.path.join(project_path, relative_path)
+    encodings = {}
+    for encoding, open_writer in compressors().items():
+        path = sidecar_path(project_path, relative_path, encoding)
+        temp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(source_path, "rb") as source, open(temp_path, "wb") as target:
+            with open_writer(target) as writer:
+                shutil.copyfileobj(source, writer, BLOCK_SIZE)
+        size = os.path.getsize(temp_path)
+        if size > file_info["size"] * (1 - COMPRESS_MIN_SAVING):
+            os.remove(temp_path)
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        os.utime(temp_path, ns=(file_info["last_modified_ns"], file_info["last_modified_ns"]))
+        os.replace(temp_path, path)
+        encodings[encoding] = size
+    return encodings
+
+def compress_files(project_path, checksums):
+    # Compression happens here once per published file version, never per request
+    to_compress = []
+    for relative_path, file_info in checksums.items():
+        if not COMPRESS or not COMPRESS_MIN_SIZE <= file_info["size"] <= COMPRESS_MAX_SIZE:
+            file_info.pop("encodings", None)
+            continue
+        encodings = valid_sidecars(project_path, relative_path, file_info) if "encodings" in file_info else None
+        if encodings is None:
+            to_compress.append(relative_path)
+        else:
+            file_info["encodings"] = encodings
+
+    with ThreadPoolExecutor() as executor:
+        futures = {
+            executor.submit(compress_file, project_path, relative_path, checksums[relative_path]): relative_path
+            for relative_path in to_compress
+        }
+        for future in as_completed(futures):
+            relative_path = futures[future]
+            try:
+                checksums[relative_path]["encodings"] = future.result()
+            except Exception as e:
+                logger.error(f"Error compressing file {relative_path}: {e}")
+                checksums[relative_path].pop("encodings", None)
+    if to_compress:
+        logger.info(f"Compressed {len(to_compress)} files")
+
+    # Drop sidecars no manifest entry refers to any more
+    compressed_root = os.path.join(project_path, COMPRESSED_DIR)
+    wanted = {
+        sidecar_path(project_path, relative_path, encoding)
+        for relative_path, file_info in checksums.items()
+        for encoding in file_info.get("encodings", {})
+    }
+    for root, _, files in os.walk(compressed_root):
+        for file in files:
+            path = os.path.join(root, file)
+            if path not in wanted:
+                os.remove(path)
+
+def load_previous_manifest(project_path):
+    # Previous files_info.json, its entries with their block signatures attached again as
+    # generate_checksum_for_file returns them
+    try:
+        with open(os.path.join(project_path, "files_info.json"), "r") as f:
+            manifest = json.load(f)
+        files = manifest["files"]
+    except (OSError, ValueError, KeyError):
+        return {"files": {}}
+    try:
+        with open(os.path.join(project_path, "block_signatures.json"), "r") as f:
+            signatures = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        signatures = {}
+    for file_name, file_info in files.items():
+        signature = signatures.get(file_name)
+        if signature is not None and signature["checksum"] == file_info.get("checksum"):
+            file_info["blocks"] = {key: signature[key] for key in ("size", "weak", "strong")}
+    return manifest
+
+def manifest_changes(previous, files):
+    return {
+        "added": sorted(file_name for file_name in files if file_name not in previous),
+        "changed": sorted(
+            file_name for file_name, file_info in files.items()
+            if file_name in previous
+            and any(previous[file_name].get(key) != file_info.get(key) for key in CHANGE_KEYS)
+        ),
+        "removed": sorted(file_name for file_name in previous if file_name not in files),
+    }
+
+def update_history(project_path, previous, files):
+    # Returns the revision for the new manifest. Revisions only ever grow: when the previous
+    # manifest carries none (first run, or written by another tool) the change list restarts,
+    # but the counter continues from the history file so no client can mistake an old revision.
+    history_file = os.path.join(project_path, "manifest_history.json")
+    try:
+        with open(history_file, "r") as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        history = {"revision": 0, "revisions": []}
+
+    revision = previous.get("revision")
+    if revision is None or revision != history["revision"]:
+        revision = max(revision or 0, history["revision"]) + 1
+        history = {"revision": revision, "revisions": []}
+    else:
+        changes = manifest_changes(previous["files"], files)
+        if not any(changes.values()):
+            return revision
+        revision += 1
+        history["revision"] = revision
+        history["revisions"] = (history["revisions"] + [{"revision": revision, **changes}])[-MANIFEST_HISTORY:]
+        logger.info(
+            f"Revision {revision}: {len(changes['added'])} added, "
+            f"{len(changes['changed'])} changed, {len(changes['removed'])} removed"
+        )
+    write_json(history_file, history, separators=(",", ":"))
+    return revision
+
+def write_json(path, data, **kwargs):
+    # Write next to the target and rename, the server never sees a half-written manifest
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(temp_path, path)
+
+def write_manifest_pages(project_path, files_info):
+    # Pages are written one line at a time from the sorted entries, the index goes last and
+    # publishes them. It records the stat of the files_info.json it was made from, which is how
+    # the server tells a current index from one another tool left behind
+    manifest_dir = os.path.join(project_path, MANIFEST_DIR)
+    index_file = os.path.join(manifest_dir, "index.json")
+    os.makedirs(manifest_dir, exist_ok=True)
+    try:
+        with open(index_file, "r") as f:
+            generation = json.load(f)["generation"] + 1
+    except (OSError, ValueError, KeyError):
+        generation = 1
+
+    names = sorted(files_info["files"])
+    pages = []
+    for start in range(0, len(names), MANIFEST_PAGE_SIZE):
+        page_names = names[start:start + MANIFEST_PAGE_SIZE]
+        page_file = os.path.join(manifest_dir, f"{generation}-{len(pages)}.ndjson")
+        with open(f"{page_file}.tmp", "w") as f:
+            for name in page_names:
+                f.write(json.dumps([name, files_info["files"][name]], separators=(",", ":"), default=str))
+                f.write("\n")
+        os.replace(f"{page_file}.tmp", page_file)
+        # Manifests compress several times over, the server sends this copy to gzip clients
+        with open(page_file, "rb") as source, gzip.open(f"{page_file}.gz.tmp", "wb", compresslevel=9) as target:
+            shutil.copyfileobj(source, target)
+        os.replace(f"{page_file}.gz.tmp", f"{page_file}.gz")
+        pages.append({"first": page_names[0], "last": page_names[-1], "files": len(page_names)})
+
+    stat = os.stat(os.path.join(project_path, "files_info.json"))
+    write_json(index_file, {
+        "version": files_info["version"],
+        "revision": files_info["revision"],
+        "generation": generation,
+        "files": len(names),
+        "pages": pages,
+        "source": [stat.st_size, stat.st_mtime_ns],
+    }, separators=(",", ":"))
+
+    for name in os.listdir(manifest_dir):
+        # Also catches the .tmp of an interrupted run
+        if ".ndjson" in name and int(name.split("-")[0]) < generation - 1:
+            os.remove(os.path.join(manifest_dir, name))
+
 def save_files_info(project_path):
     output_file = os.path.join(project_path, "files_info.json")
-    checksums = generate_checksums(project_path)
+    signatures_file = os.path.join(project_path, "block_signatures.json")
+    previous = load_previous_manifest(project_path)
+    checksums = generate_checksums(project_path, previous["files"] if INCREMENTAL else {})
+    compress_files(project_path, checksums)
+    revision = update_history(project_path, previous, checksums)
+
+    # Block signatures are only fetched per file when patching, keep them out of the manifest
+    signatures = {}
+    for file_name, file_info in checksums.items():
+        blocks = file_info.pop("blocks", None)
+        if blocks is not None:
+            signatures[file_name] = {
+                "checksum": file_info["checksum"],
+                "block_size": file_info["block_size"],
+                **blocks,
+            }
+            # The client re-checks patched files with the same algorithm as the manifest
+            if "hash_algorithm" in file_info:
+                signatures[file_name]["hash_algorithm"] = file_info["hash_algorithm"]
+                signatures[file_name]["hash_chunk_size"] = file_info["hash_chunk_size"]
 
     files_info = {
         "version": os.path.basename(project_path),
+        "revision": revision,
         "files": checksums,
     }
 
-    with open(output_file, "w") as f:
-        json.dump(files_info, f, indent=4, default=str)
+    write_json(signatures_file, {"files": signatures}, separators=(",", ":"))
+    write_json(output_file, files_info, separators=(",", ":"), default=str)
+    write_manifest_pages(project_path, files_info)
 
     logger.info(f"Saved files_info.json to {output_file}")
 
@@ -75,6 +439,8 @@ def generate_for_all_projects(base_directory):
         open(str(PROJECT_DATA_PATH), "w").write(json.dumps({}))
     project_data = json.loads(open(PROJECT_DATA_PATH, "r").read())
     for project in os.listdir(base_directory):
+        if project == BLOBS_DIR:
+            continue
         project_path = os.path.join(base_directory, project)
         if os.path.isdir(project_path):
             logger.info(f"Generating files_info.json for project {project}")
@@ -0,0 +1,165 @@
+import os
+import sys
+import lzma
+import shutil
+import struct
+import hashlib
+import logging
+import time
+
+import dotenv
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Publishes a new game_updater.exe to <BASE_PATH>/deploy/ together with binary patches from the
+# UPDATE_HISTORY previous versions, so update.py downloads a patch instead of the whole executable.
+#
+# deploy/game_updater.exe                      the current version, served by /download_update/
+# deploy/versions/<md5>.exe                    earlier versions the patches are built from
+# deploy/patches/<from md5>-<to md5>.patch     served by /download_update/patch/<from md5>/
+#
+# A patch is PATCH_MAGIC, the target size and an xz stream of operations: b"C" + offset + length
+# copies a range of the old file, b"I" + length + data inserts new bytes, b"E" ends the patch.
+# Matches are found on MATCH_BLOCK sized blocks of the old file at any offset of the new one,
+# which catches the unchanged archive members a PyInstaller rebuild shifts around.
+
+BASE_PATH = os.getenv("BASE_PATH") or ""
+UPDATE_HISTORY = int(os.getenv("UPDATE_HISTORY") or 0) or 5
+EXECUTABLE_NAME = "game_updater.exe"
+PATCH_MAGIC = b"CPPATCH1"
+MATCH_BLOCK = 64
+COMPARE_STEP = 4096
+
+def md5_file(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def match_length(old, old_offset, new, new_offset):
+    length = 0
+    limit = min(len(old) - old_offset, len(new) - new_offset)
+    # Compare whole steps first, then finish the last one byte by byte
+    while length + COMPARE_STEP <= limit and (
+        old[old_offset + length:old_offset + length + COMPARE_STEP]
+        == new[new_offset + length:new_offset + length + COMPARE_STEP]
+    ):
+        length += COMPARE_STEP
+    while length < limit and old[old_offset + length] == new[new_offset + length]:
+        length += 1
+    return length
+
+def diff(old, new):
+    index = {}
+    for offset in range(0, len(old) - MATCH_BLOCK + 1, MATCH_BLOCK):
+        index.setdefault(old[offset:offset + MATCH_BLOCK], offset)
+
+    literal_start = 0
+    position = 0
+    while position + MATCH_BLOCK <= len(new):
+        old_offset = index.get(new[position:position + MATCH_BLOCK])
+        if old_offset is None:
+            position += 1
+            continue
+        # Grow the match back into the pending literal bytes, then forward as far as it goes
+        start = position
+        while start > literal_start and old_offset > 0 and new[start - 1] == old[old_offset - 1]:
+            start -= 1
+            old_offset -= 1
+        length = match_length(old, old_offset, new, start)
+        if start > literal_start:
+            yield "I", new[literal_start:start]
+        yield "C", old_offset, length
+        position = literal_start = start + length
+    if literal_start < len(new):
+        yield "I", new[literal_start:]
+
+def write_patch(old_path, new_path, patch_path):
+    with open(old_path, "rb") as f:
+        old = f.read()
+    with open(new_path, "rb") as f:
+        new = f.read()
+    temp_path = f"{patch_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(PATCH_MAGIC + struct.pack(">Q", len(new)))
+        with lzma.open(f, "wb", preset=9) as stream:
+            for operation in diff(old, new):
+                if operation[0] == "C":
+                    stream.write(b"C" + struct.pack(">QQ", operation[1], operation[2]))
+                else:
+                    stream.write(b"I" + struct.pack(">Q", len(operation[1])) + operation[1])
+            stream.write(b"E")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, patch_path)
+    return os.path.getsize(patch_path)
+
+def install(source_path, target_path):
+    temp_path = f"{target_path}.tmp"
+    shutil.copyfile(source_path, temp_path)
+    with open(temp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, target_path)
+
+def publish(new_path, deploy_dir):
+    versions_dir = os.path.join(deploy_dir, "versions")
+    patches_dir = os.path.join(deploy_dir, "patches")
+    os.makedirs(versions_dir, exist_ok=True)
+    os.makedirs(patches_dir, exist_ok=True)
+    current_path = os.path.join(deploy_dir, EXECUTABLE_NAME)
+
+    new_version = md5_file(new_path)
+    if os.path.exists(current_path):
+        current_version = md5_file(current_path)
+        if current_version == new_version:
+            logger.info(f"Version {new_version} is already published")
+            return
+        archived_path = os.path.join(versions_dir, f"{current_version}.exe")
+        if not os.path.exists(archived_path):
+            install(current_path, archived_path)
+        # Archiving marks the version as the most recent one, also when it was published before
+        os.utime(archived_path)
+
+    versions = sorted(
+        (name for name in os.listdir(versions_dir) if name.endswith(".exe")),
+        key=lambda name: os.path.getmtime(os.path.join(versions_dir, name)),
+        reverse=True,
+    )
+    for name in versions[UPDATE_HISTORY:]:
+        os.remove(os.path.join(versions_dir, name))
+
+    new_size = os.path.getsize(new_path)
+    for name in versions[:UPDATE_HISTORY]:
+        old_version = name[:-len(".exe")]
+        if old_version == new_version:
+            continue
+        patch_path = os.path.join(patches_dir, f"{old_version}-{new_version}.patch")
+        if os.path.exists(patch_path):
+            continue
+        start = time.time()
+        size = write_patch(os.path.join(versions_dir, name), new_path, patch_path)
+        # A patch that saves nothing is only slower than the full download
+        if size >= new_size:
+            os.remove(patch_path)
+            logger.info(f"Dropped the patch from {old_version}, it is not smaller than the executable")
+        else:
+            logger.info(f"Patch from {old_version}: {size} of {new_size} bytes in {time.time() - start:.2f}s")
+
+    # Patches are in place before the executable changes, the server lists them when it sees the new one
+    install(new_path, current_path)
+    for name in os.listdir(patches_dir):
+        if not name.endswith(f"-{new_version}.patch"):
+            os.remove(os.path.join(patches_dir, name))
+    logger.info(f"Published version {new_version}")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    if len(sys.argv) != 2:
+        raise SystemExit(f"Usage: {sys.argv[0]} <path to the new game_updater.exe>")
+    publish(sys.argv[1], os.path.join(BASE_PATH, "deploy"))